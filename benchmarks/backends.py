@@ -0,0 +1,132 @@
+#!/usr/bin/env python3.6
+"""compare the entities and the time of NER backends to the reference backend
+
+    python benchmarks/backends.py texts/*.txt --backends quantized --language fr
+    python benchmarks/backends.py news.txt --backends quantized --min-f1 0.95
+
+the texts are tagged with each backend and with the reference backend
+(deeppavlov by default), the precision, recall and f1 of the entities of each
+backend are computed against the reference entities (see evaluate_backends())
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from ner.ner import BACKENDS, NETagger
+
+
+def compare_entities(reference: list, entities: list) -> dict:
+    """return the number of entities of the reference found in entities
+    (same start, end and annotation), missing and added"""
+    reference = {(ent["start"], ent["end"], ent["annotation"]) for ent in reference}
+    entities = {(ent["start"], ent["end"], ent["annotation"]) for ent in entities}
+    return {
+        "same": len(reference & entities),
+        "missing": len(reference - entities),
+        "added": len(entities - reference),
+    }
+
+
+def evaluate_backends(
+    texts, backends, reference="deeppavlov", language=None, batch_size=32
+) -> dict:
+    """tag the texts with each backend and with the reference backend, and
+    return how far the entities of each backend are from the reference ones:
+    >>> evaluate_backends(texts, ["quantized"], language="fr")
+        {'quantized': {'precision': 0.98, 'recall': 0.97, 'f1': 0.975,
+        'same_documents': 0.9, 'seconds': 12.1, 'reference_seconds': 30.4, ...}}
+
+    a backend is the name of a backend (see BACKENDS) or a model (see NERBackend)
+    precision and recall are computed on the entities (same start, end and
+    annotation), same_documents is the ratio of texts with the same entities
+    """
+    texts = list(texts)
+
+    def tag(backend):
+        if isinstance(backend, str):
+            tagger = NETagger(language=language, train_model=False, backend=backend)
+        else:
+            tagger = NETagger(language=language, train_model=False)
+            tagger.ner_model = backend
+        start = time.perf_counter()
+        ls_entities = list(tagger.predict_many(texts, language, batch_size=batch_size))
+        return ls_entities, time.perf_counter() - start
+
+    reference_entities, reference_seconds = tag(reference)
+    results = {}
+    for backend in backends:
+        ls_entities, seconds = tag(backend)
+        comparisons = [
+            compare_entities(ref, ents)
+            for ref, ents in zip(reference_entities, ls_entities)
+        ]
+        same = sum(comparison["same"] for comparison in comparisons)
+        missing = sum(comparison["missing"] for comparison in comparisons)
+        added = sum(comparison["added"] for comparison in comparisons)
+        precision = same / (same + added) if same + added else 1.0
+        recall = same / (same + missing) if same + missing else 1.0
+        name = backend if isinstance(backend, str) else type(backend).__name__
+        results[name] = {
+            "precision": precision,
+            "recall": recall,
+            "f1": (
+                2 * precision * recall / (precision + recall)
+                if precision + recall
+                else 0.0
+            ),
+            "same_documents": sum(
+                not (comparison["missing"] or comparison["added"])
+                for comparison in comparisons
+            )
+            / max(len(texts), 1),
+            "same": same,
+            "missing": missing,
+            "added": added,
+            "seconds": seconds,
+            "reference_seconds": reference_seconds,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("texts", nargs="+", help="text files")
+    parser.add_argument(
+        "--backends", nargs="+", default=["quantized"], choices=list(BACKENDS)
+    )
+    parser.add_argument("--reference", default="deeppavlov", choices=list(BACKENDS))
+    parser.add_argument(
+        "--language", help="language of the texts (detected if not set)"
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-f1", type=float, help="exit with an error below")
+    parser.add_argument("--output", help="json file to save the results")
+    args = parser.parse_args()
+
+    texts = []
+    for path in args.texts:
+        with open(path, encoding="UTF-8") as f:
+            texts.append(f.read())
+    results = evaluate_backends(
+        texts, args.backends, args.reference, args.language, args.batch_size
+    )
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.min_f1 is not None:
+        below = [name for name, result in results.items() if result["f1"] < args.min_f1]
+        for name in below:
+            print(f"the f1 of {name} is below {args.min_f1}", file=sys.stderr)
+        sys.exit(1 if below else 0)
+
+
+if __name__ == "__main__":
+    main()
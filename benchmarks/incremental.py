@@ -0,0 +1,124 @@
+#!/usr/bin/env python3.6
+"""check that tagging an edited text incrementally (NETagger(incremental=True))
+gives the same entities as tagging the whole edited text, on random edits
+
+    python benchmarks/incremental.py                       # 200 edits per language
+    python benchmarks/incremental.py --edits 1000 --size 50000 --seed 3
+    python benchmarks/incremental.py --stub-delay-per-token 0.00001  # emulate the model cost
+
+a synthetic text (see suite.synthetic_text()) is edited again and again at
+random positions (words, sentences, names, new lines inserted, spans deleted or
+replaced), after each edit the entities of predict() on the incremental tagger
+are compared to the ones of a new tagger, both with the StubNERModel.
+Exits with an error if the entities of an edit differ.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+# imported before ner.ner: suite puts src and src/nlp_utils on the path
+from suite import NAMES, VOCABULARIES, synthetic_text
+from ner.ner import NETagger, StubNERModel
+
+DEFAULT_LANGUAGES = ["fr", "en"]
+
+
+def random_edit(text: str, language: str, rng: random.Random) -> str:
+    """return the text with a random edit at a random position"""
+    start = rng.randint(0, len(text))
+    choice = rng.random()
+    if choice < 0.3:
+        inserted = " ".join(
+            rng.choice(VOCABULARIES[language]) for _ in range(rng.randint(1, 5))
+        )
+        return f"{text[:start]} {inserted} {text[start:]}"
+    if choice < 0.45:
+        sentence = synthetic_text(rng.randint(20, 200), language, rng.random())
+        return text[:start] + sentence + text[start:]
+    if choice < 0.55:
+        return text[:start] + rng.choice(["\n\n", ". ", "\n"]) + text[start:]
+    end = min(start + rng.randint(1, 200), len(text))
+    if choice < 0.8:
+        return text[:start] + text[end:]
+    return text[:start] + rng.choice(NAMES) + text[end:]
+
+
+def check_edits(language: str, args) -> dict:
+    """edit the text args.edits times and compare the entities of the
+    incremental tagger to the ones of a new tagger after each edit"""
+    rng = random.Random(f"{args.seed}-{language}")
+    text = synthetic_text(args.size, language, args.seed)
+    tagger = NETagger(text, language=language, train_model=False, incremental=True)
+    tagger.ner_model = StubNERModel(args.stub_delay, args.stub_delay_per_token)
+    tagger.predict(batch_size=args.batch_size)
+
+    results = {"edits": 0, "mismatches": [], "incremental_time": 0.0, "full_time": 0.0}
+    for index in range(args.edits):
+        edited = random_edit(text, language, rng)
+        if not edited.strip():
+            continue
+        text = edited
+        start = time.perf_counter()
+        tagger.new_text(text, language)
+        entities = tagger.predict(batch_size=args.batch_size)
+        results["incremental_time"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        full_tagger = NETagger(text, language=language, train_model=False)
+        full_tagger.ner_model = StubNERModel(args.stub_delay, args.stub_delay_per_token)
+        full_entities = full_tagger.predict(batch_size=args.batch_size)
+        results["full_time"] += time.perf_counter() - start
+
+        results["edits"] += 1
+        if entities != full_entities:
+            results["mismatches"].append(index)
+    results["speedup"] = results["full_time"] / max(results["incremental_time"], 1e-9)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--edits", type=int, default=200, help="edits per language")
+    parser.add_argument(
+        "--size", type=int, default=20_000, help="size of the texts in characters"
+    )
+    parser.add_argument(
+        "--languages", nargs="+", default=DEFAULT_LANGUAGES, choices=VOCABULARIES
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="per call")
+    parser.add_argument(
+        "--stub-delay-per-token", type=float, default=0.0, help="per token"
+    )
+    parser.add_argument("--output", help="json file to save the results")
+    args = parser.parse_args()
+
+    results = {language: check_edits(language, args) for language in args.languages}
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    mismatches = {
+        language: result["mismatches"]
+        for language, result in results.items()
+        if result["mismatches"]
+    }
+    if mismatches:
+        print(
+            f"the incremental entities differ after the edits {mismatches}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3.6
+"""measure the startup time of the ner module:
+    - the time to import NETagger
+    - the time to get the entities of a first (short) text,
+      including the loading of the models
+
+    python benchmarks/startup.py                        # import and first prediction
+    python benchmarks/startup.py --no-predict           # import only, no model needed
+    python benchmarks/startup.py --max-import-time 0.5  # exit with an error if slower
+
+each measure is done in a new python process, so that no module or model
+is already loaded
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# modules that should not be imported by `from ner.ner import NETagger`
+HEAVY_MODULES = ["spacy", "deeppavlov", "tensorflow", "langdetect", "tqdm", "nltk"]
+
+MEASURE_SCRIPT = """
+import json
+import sys
+import time
+
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+from ner.ner import NETagger
+results = {{"import_time": time.perf_counter() - start}}
+results["heavy_modules_imported"] = [
+    module for module in {heavy_modules!r} if module in sys.modules
+]
+if {predict!r}:
+    start = time.perf_counter()
+    NETagger({text!r}, language={language!r}).predict()
+    results["first_prediction_time"] = time.perf_counter() - start
+print(json.dumps(results))
+"""
+
+DEFAULT_TEXT = "Miguel de Cervantes est né à Alcalá de Henares en 1547."
+
+
+def measure(predict=True, text=DEFAULT_TEXT, language=None) -> dict:
+    """run the measure in a new python process and return its results"""
+    script = MEASURE_SCRIPT.format(
+        src=SRC_LOCATION,
+        heavy_modules=HEAVY_MODULES,
+        predict=predict,
+        text=text,
+        language=language,
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, stdout=subprocess.PIPE
+    ).stdout
+    # the last line is the json, the previous ones can be printed by the models
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs")
+    parser.add_argument("--no-predict", action="store_true")
+    parser.add_argument("--text", default=DEFAULT_TEXT)
+    parser.add_argument("--language", default=None)
+    parser.add_argument("--max-import-time", type=float, help="in seconds")
+    parser.add_argument("--max-first-prediction-time", type=float, help="in seconds")
+    parser.add_argument("--output", help="json file to save the results")
+    args = parser.parse_args()
+
+    runs = [
+        measure(not args.no_predict, args.text, args.language)
+        for _ in range(args.repeat)
+    ]
+    results = {"runs": runs}
+    for key in ["import_time", "first_prediction_time"]:
+        values = [run[key] for run in runs if key in run]
+        if values:
+            results[key] = {"min": min(values), "median": statistics.median(values)}
+    results["heavy_modules_imported"] = runs[0]["heavy_modules_imported"]
+
+    print(json.dumps({k: v for k, v in results.items() if k != "runs"}, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            json.dump(results, f, indent=4)
+
+    errors = []
+    if results["heavy_modules_imported"]:
+        errors.append(f"importing NETagger imports {results['heavy_modules_imported']}")
+    if args.max_import_time and results["import_time"]["median"] > args.max_import_time:
+        errors.append(f"import time is above {args.max_import_time}s")
+    if (
+        args.max_first_prediction_time
+        and results["first_prediction_time"]["median"] > args.max_first_prediction_time
+    ):
+        errors.append(
+            f"first prediction time is above {args.max_first_prediction_time}s"
+        )
+    for error in errors:
+        print(error, file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3.6
+"""time each stage of the NER pipeline on synthetic corpora, with the
+StubNERModel instead of the BERT models (no model to download)
+
+    python benchmarks/suite.py --sizes 10000 100000 --output baseline.json
+    python benchmarks/suite.py --compare baseline.json --max-regression 0.2
+    python benchmarks/suite.py --stub-delay-per-token 0.00001  # emulate the model cost
+
+the stages are: the tokenization into sentences (nlp_utils), the spacy
+tokenization, the whole NETagger._tokenize(), the inference (stub model), the
+BIO decoding, NETagger.predict(), the exports of the Serializer and the
+alignment of the TreeTagger tokens (nlp_utils.align_tokens()).
+Each stage is run --repeat times and its min and median times are saved, with
+the versions and the machine, as a json baseline that later runs are compared
+to (--compare, exits with an error if a stage is slower than the baseline by
+more than --max-regression).
+The corpora are generated from a seed: the same arguments give the same texts.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import treetaggerwrapper
+from ner.ner import NETagger, StubNERModel, get_nlp_small
+
+# the nlp_utils module used by NETagger (ner.ner adds src/nlp_utils to the path)
+from nlp_utils import align_tokens, tokenize_into_sentences
+from serialize.serialize import Serializer
+
+DEFAULT_SIZES = [10_000, 100_000]
+DEFAULT_LANGUAGES = ["fr", "en", "de", "es"]
+# words of the synthetic sentences, the names are tagged as PERSON by the stub
+VOCABULARIES = {
+    "fr": "le chat de la mère mange une souris grise près du moulin et".split(),
+    "en": "the cat of the old miller eats a grey mouse near the mill and".split(),
+    "de": "die Katze der alten Müllerin frisst eine graue Maus bei der".split(),
+    "es": "el gato de la madre come un ratón gris cerca del molino y".split(),
+}
+NAMES = ["Miguel de Cervantes", "Marie Curie", "Alcalá", "Henares", "Obama"]
+SERIALIZER_EXPORTS = ["tsv", "json", "temporary_json", "html", "columnar"]
+
+
+def synthetic_text(size: int, language: str, seed=0) -> str:
+    """return a text of about size characters in the language: sentences of
+    random words, names and numbers, with some paragraphs"""
+    rng = random.Random(f"{seed}-{language}-{size}")
+    words = VOCABULARIES[language]
+    sentences, length = [], 0
+    while length < size:
+        sentence = []
+        for _ in range(rng.randint(4, 40)):
+            choice = rng.random()
+            if choice < 0.08:
+                sentence.append(rng.choice(NAMES))
+            elif choice < 0.12:
+                sentence.append(str(rng.randint(1, 2020)))
+            else:
+                sentence.append(rng.choice(words))
+        sentence = " ".join(sentence).capitalize() + rng.choice([". ", ". ", ".\n\n"])
+        sentences.append(sentence)
+        length += len(sentence)
+    return "".join(sentences)
+
+
+def treetagger_tags(text: str) -> list:
+    """return tags of the text the way TreeTagger makes them (the words and
+    the punctuations, '…' becomes '...'), so that TreeTagger is not needed"""
+    return [
+        treetaggerwrapper.Tag(word, "NOM", word.lower())
+        for word in re.findall(r"\w+|[^\w\s]", text.replace("…", "..."))
+    ]
+
+
+def timed(function, repeat: int) -> dict:
+    """return the min and median times of repeat calls of function"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def measure(text: str, language: str, args) -> dict:
+    """return the times of each stage on the text"""
+    tagger = NETagger(text, language=language, train_model=False)
+    tagger.ner_model = StubNERModel(args.stub_delay, args.stub_delay_per_token)
+    nlp_small = get_nlp_small()
+    sentences = tokenize_into_sentences(text, language)
+    tokens, sequences = tagger._tokenize(text, language)
+    documents = [(text, language, tokens, sequences)]
+    labels = tagger._label_documents(documents, args.batch_size)[0]
+    entities = tagger._decode(text, tokens, labels)
+
+    stages = {
+        "sentences": lambda: tokenize_into_sentences(text, language),
+        "spacy": lambda: list(
+            nlp_small.pipe(text[start:end] for start, end in sentences)
+        ),
+        "tokenize": lambda: tagger._tokenize(text, language),
+        "inference": lambda: tagger._label_documents(documents, args.batch_size),
+        "decode": lambda: tagger._decode(text, tokens, labels),
+        "predict": lambda: tagger.predict(batch_size=args.batch_size),
+    }
+    results = {
+        "text_length": len(text),
+        "sentences": len(sentences),
+        "tokens": len(tokens),
+        "sequences": len(sequences),
+        "entities": len(entities),
+        "stages": {},
+    }
+    # the exported files are removed once the stages are timed
+    with tempfile.TemporaryDirectory() as out_dir:
+        serializer = Serializer(text, entities, safe_check=False)
+        for format_ in SERIALIZER_EXPORTS:
+            export = getattr(serializer, f"to_{format_}")
+            out_file = os.path.join(out_dir, f"entities.{format_}")
+            stages[f"to_{format_}"] = functools.partial(export, out_file)
+        tags = treetagger_tags(text)
+        stages["tag_alignment"] = lambda: align_tokens(text, tags)
+        for stage, function in stages.items():
+            if args.stages and stage not in args.stages:
+                continue
+            results["stages"][stage] = timed(function, args.repeat)
+    return results
+
+
+def environment() -> dict:
+    """return what the times depend on: versions, machine and commit"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        commit = commit.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """print the ratio of the median times to the baseline and return the
+    stages slower than the baseline by more than max_regression"""
+    regressions = []
+    for corpus, corpus_results in results["corpora"].items():
+        baseline_stages = baseline["corpora"].get(corpus, {}).get("stages", {})
+        for stage, times in corpus_results["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            ratio = times["median"] / max(baseline_stages[stage]["median"], 1e-9)
+            print(f"{corpus:>12} {stage:>20}: {ratio:.2f}x baseline")
+            if ratio > 1 + max_regression:
+                regressions.append(f"{corpus} {stage}: {ratio:.2f}x baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="sizes of the texts in characters",
+    )
+    parser.add_argument(
+        "--languages", nargs="+", default=DEFAULT_LANGUAGES, choices=VOCABULARIES
+    )
+    parser.add_argument("--stages", nargs="+", help="stages to run (all by default)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="per call")
+    parser.add_argument("--stub-delay-per-token", type=float, default=0.0)
+    parser.add_argument("--output", help="json file to save the results (baseline)")
+    parser.add_argument("--compare", help="json baseline to compare the results to")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+    # the warnings of the stages (eg: acronyms of the tag alignment)
+    logging.disable(logging.WARNING)
+
+    results = {"environment": environment(), "arguments": vars(args), "corpora": {}}
+    for language in args.languages:
+        for size in args.sizes:
+            text = synthetic_text(size, language, args.seed)
+            results["corpora"][f"{language}-{size}"] = measure(text, language, args)
+    print(json.dumps(results["corpora"], indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="UTF-8") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare, encoding="UTF-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3.6
+"""compare the alignment of the TreeTagger tokens on the text with
+nlp_utils.align_tokens() to the previous implementation of
+TreeTaggerImproved.tag_text_tokens() (slices of the rest of the text)
+
+    python benchmarks/tag_alignment.py                      # synthetic texts
+    python benchmarks/tag_alignment.py --lengths 1000000 10000000 --max-slice-length 0
+
+the tags are made the way TreeTagger makes them ('…' becomes '...', a final
+dot is added to the acronyms), so TreeTagger is not needed, the tokens of both
+implementations are checked to be the same
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import treetaggerwrapper
+from nlp_utils.nlp_utils import align_tokens
+
+DEFAULT_LENGTHS = [10_000, 100_000, 1_000_000]
+WORDS = "Elles mangent des pommes vertes près du moulin de la mère Michel".split()
+
+
+def slice_align_tokens(text: str, tags: list) -> list:
+    """the previous implementation of TreeTaggerImproved.tag_text_tokens()"""
+    ls_tokens = []
+    last_pos = 0
+    for tag in tags:
+        word = tag[0]
+        if word == "...":
+            if re.match(r"\s*…", text[last_pos:]):
+                word = "…"
+        num_spaces_after_last_token = re.match(r"\s*", text[last_pos:]).span()[1]
+        try:
+            token_position = last_pos + text[
+                last_pos : last_pos + num_spaces_after_last_token + len(word)
+            ].index(word)
+        except ValueError:
+            token_position = last_pos + text[last_pos:].index(word.strip("."))
+            word = word.strip(".")
+        token = {
+            "word": word,
+            "pos": tag[1],
+            "lemma": tag[2],
+            "start": token_position,
+            "end": token_position + len(word),
+        }
+        ls_tokens.append(token)
+        last_pos = token["end"]
+    return ls_tokens
+
+
+def synthetic_text(length: int, seed=0):
+    """return a text of about length characters and its TreeTagger tags"""
+    rng = random.Random(seed)
+    pieces, tags, size = [], [], 0
+    while size < length:
+        choice = rng.random()
+        if choice < 0.02:
+            # '…' is tagged as '...'
+            word, tag_word = "…", "..."
+        elif choice < 0.04:
+            word = tag_word = "..."
+        elif choice < 0.06:
+            # the acronyms get a final dot
+            word = "U.S.A"
+            tag_word = word + "."
+        else:
+            word = tag_word = rng.choice(WORDS)
+        space = rng.choice([" ", " ", " ", "\n", "  \t"])
+        pieces.append(word + space)
+        tags.append(treetaggerwrapper.Tag(tag_word, "NOM", tag_word.lower()))
+        size += len(word) + len(space)
+    return "".join(pieces), tags
+
+
+def measure(text: str, tags: list, max_slice_length: int) -> dict:
+    result = {"text_length": len(text), "tokens": len(tags)}
+    time_start = time.perf_counter()
+    tokens = align_tokens(text, tags)
+    result["align_time"] = time.perf_counter() - time_start
+
+    if len(text) <= max_slice_length:
+        time_start = time.perf_counter()
+        slice_tokens = slice_align_tokens(text, tags)
+        result["slice_time"] = time.perf_counter() - time_start
+        result["same_tokens"] = slice_tokens == tokens
+        result["speedup"] = result["slice_time"] / result["align_time"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=DEFAULT_LENGTHS,
+        help="lengths of the synthetic texts",
+    )
+    parser.add_argument(
+        "--max-slice-length",
+        type=int,
+        default=1_000_000,
+        help="the previous implementation is not run on longer texts",
+    )
+    parser.add_argument("--output", help="json file to save the results")
+    args = parser.parse_args()
+    # the acronyms are logged by align_tokens()
+    logging.disable(logging.WARNING)
+
+    results = []
+    for length in args.lengths:
+        text, tags = synthetic_text(length)
+        results.append(measure(text, tags, args.max_slice_length))
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if not all(result.get("same_tokens", True) for result in results):
+        print("the tokens differ from the previous implementation", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3.6
+"""compare the computation of the unique prefixes of Serializer.to_temporary_json()
+with the PrefixIndex to the previous implementation (occurrences() of longer
+and longer prefixes)
+
+    python benchmarks/unique_prefix.py                       # synthetic texts
+    python benchmarks/unique_prefix.py --text book.txt --entities 20000
+    python benchmarks/unique_prefix.py --max-scan-length 200000  # skip the scan above
+
+the texts repeat paragraphs (boilerplate), so that the prefixes have to be
+longer than 100 characters to be unique, the prefixes of both implementations
+are checked to be the same
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from serialize.serialize import PrefixIndex, occurrences
+
+DEFAULT_LENGTHS = [10_000, 100_000, 1_000_000]
+WORDS = "le chat de la mère Michel a mangé une souris grise près du moulin".split()
+
+
+def scan_prefix_start(text: str, start: int, nb_char_suffix=100) -> int:
+    """the previous implementation of Serializer.to_temporary_json()"""
+    for i in range(nb_char_suffix, start, 50):
+        prefix_start = start - i
+        if occurrences(text, text[prefix_start:start]) > 1:
+            continue
+        return prefix_start
+    return 0
+
+
+def synthetic_text(length: int, seed=0) -> str:
+    """return a text of length characters made of random sentences and
+    of repeated paragraphs"""
+    rng = random.Random(seed)
+    boilerplate = [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) + ".\n"
+        for _ in range(5)
+    ]
+    pieces, size = [], 0
+    while size < length:
+        if rng.random() < 0.3:
+            piece = rng.choice(boilerplate)
+        else:
+            piece = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30)))
+            piece += ". "
+        pieces.append(piece)
+        size += len(piece)
+    return "".join(pieces)[:length]
+
+
+def measure(text: str, nb_entities: int, max_scan_length: int, seed=0) -> dict:
+    rng = random.Random(seed)
+    starts = sorted(rng.randrange(len(text)) for _ in range(nb_entities))
+    result = {"text_length": len(text), "entities": nb_entities}
+
+    time_start = time.perf_counter()
+    index = PrefixIndex(text)
+    result["index_build_time"] = time.perf_counter() - time_start
+    index_starts = [index.unique_prefix_start(start, 100, 50) for start in starts]
+    result["index_time"] = time.perf_counter() - time_start
+
+    if len(text) <= max_scan_length:
+        time_start = time.perf_counter()
+        scan_starts = [scan_prefix_start(text, start) for start in starts]
+        result["scan_time"] = time.perf_counter() - time_start
+        result["same_prefixes"] = scan_starts == index_starts
+        result["speedup"] = result["scan_time"] / result["index_time"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--text", help="text file (synthetic texts by default)")
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=DEFAULT_LENGTHS,
+        help="lengths of the synthetic texts",
+    )
+    parser.add_argument("--entities", type=int, default=2000)
+    parser.add_argument(
+        "--max-scan-length",
+        type=int,
+        default=1_000_000,
+        help="the previous implementation is not run on longer texts",
+    )
+    parser.add_argument("--output", help="json file to save the results")
+    args = parser.parse_args()
+
+    if args.text:
+        with open(args.text, encoding="UTF-8") as f:
+            texts = [f.read()]
+    else:
+        texts = [synthetic_text(length) for length in args.lengths]
+    results = [measure(text, args.entities, args.max_scan_length) for text in texts]
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if not all(result.get("same_prefixes", True) for result in results):
+        print("the prefixes differ from the previous implementation", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
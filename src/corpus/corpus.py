@@ -0,0 +1,307 @@
+#!/bin/python3.6
+"""
+tag a corpus with NETagger using several processes
+
+    python src/corpus/corpus.py corpus_dir/ -o entities.jsonl --workers 4
+    python src/corpus/corpus.py news.jsonl -o entities.jsonl --text-field body
+    python src/corpus/corpus.py corpus_dir/ -o entities.tsv.gz  # compressed tsv
+
+Each worker process loads the NER model once, the documents are sent to the
+workers through a bounded queue and the entities are written (one json line per
+document) as soon as they are found, in the order the documents are tagged:
+    {"id": "doc1.txt", "entities": [{"annotation": "PERSON", ...}, ...]}
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+
+__location__ = os.path.join(
+    os.getcwd(), os.path.dirname(inspect.getfile(inspect.currentframe()))
+)
+sys.path.insert(0, os.path.join(__location__, ".."))
+
+from serialize.serialize import open_sink
+
+# errors of a single document (check_text, inference), the other errors
+# (loading the models or the tokenizers...) stop the worker
+DOCUMENT_ERRORS = (AssertionError, ValueError, RuntimeError)
+
+
+def read_documents(path: str, pattern="*.txt", text_field="text", id_field="id"):
+    """yield the (id, text) of the documents of the corpus
+
+    path is either:
+        - a directory: the documents are the files matching pattern
+          (in the sub directories as well), their id is their relative path
+        - a jsonl file: one json per line, with the text in text_field and
+          the id in id_field (the line number if there is no id_field)
+    """
+    path = Path(path)
+    if path.is_dir():
+        for file_path in sorted(path.rglob(pattern)):
+            if file_path.is_file():
+                yield str(file_path.relative_to(path)), file_path.read_text(
+                    encoding="UTF-8"
+                )
+        return
+    with open(path, encoding="UTF-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            yield document.get(id_field, line_number), document[text_field]
+
+
+def worker(task_queue, result_queue, options: dict):
+    """tag the documents of the task queue until a None task is received
+
+    a task is a list of (id, text), a result is a list of
+    (id, entities, number of whitespace separated tokens, error),
+    or the error (str) that stopped the worker
+    """
+    logging.basicConfig(level=options["log_level"])
+
+    try:
+        from ner.ner import NETagger, set_intra_op_threads
+
+        if options["threads_per_worker"]:
+            # setting the threads before the models are imported
+            set_intra_op_threads(
+                options["threads_per_worker"],
+                inter_op_threads=options["threads_per_worker"],
+            )
+
+        # loading the model before the first task: a model that cannot be
+        # loaded stops the worker instead of failing every document
+        tagger = NETagger(language=options["language"], backend=options["backend"])
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            result_queue.put(tag_documents(tagger, task, options))
+    except Exception as e:
+        result_queue.put(f"{type(e).__name__}: {e}")
+        raise
+    result_queue.put(None)
+
+
+def tag_documents(tagger, documents: list, options: dict) -> list:
+    """return the results of the documents [(id, text), ...]
+
+    only the errors of a document (see DOCUMENT_ERRORS) are returned
+    in its result, the other errors are raised
+    """
+    texts = [text for _, text in documents]
+    try:
+        ls_entities = list(
+            tagger.predict_many(
+                texts, language=options["language"], batch_size=options["batch_size"]
+            )
+        )
+    except DOCUMENT_ERRORS as e:
+        if len(documents) == 1:
+            logging.error(f"cannot tag the document '{documents[0][0]}': {e}")
+            return [(documents[0][0], [], len(texts[0].split()), repr(e))]
+        # tagging the documents one by one to find the failing one
+        return [
+            result
+            for document in documents
+            for result in tag_documents(tagger, [document], options)
+        ]
+    return [
+        (doc_id, entities, len(text.split()), None)
+        for (doc_id, text), entities in zip(documents, ls_entities)
+    ]
+
+
+def tag_corpus(
+    documents,
+    out_file: str,
+    workers=None,
+    language=None,
+    batch_size=32,
+    docs_per_task=8,
+    queue_size=None,
+    threads_per_worker=1,
+    report_every=10.0,
+    backend="deeppavlov",
+) -> dict:
+    """tag the documents [(id, text), ...] with workers processes
+    and write the entities in out_file (see serialize.open_sink()):
+    jsonl, or tsv if out_file ends with .tsv, compressed if it ends
+    with .gz, .bz2 or .xz
+
+    return the statistics of the run:
+        {"documents": 120, "errors": 0, "tokens": 45000, "seconds": 12.3,
+         "documents_per_second": 9.7, "tokens_per_second": 3658.5}
+    the tokens are the whitespace separated tokens of the documents
+    backend is the backend of the models (see ner.BACKENDS)
+    """
+    workers = workers or os.cpu_count()
+    queue_size = queue_size or 2 * workers
+    options = {
+        "language": language,
+        "batch_size": batch_size,
+        "threads_per_worker": threads_per_worker,
+        "backend": backend,
+        "log_level": logging.getLogger().level,
+    }
+    # spawning new processes: the models do not support being forked
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue(maxsize=queue_size)
+    result_queue = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(task_queue, result_queue, options))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # the error that stopped the reading of the corpus, raised by the main thread
+    feed_errors = []
+
+    def feed():
+        """send the documents to the workers, by tasks of docs_per_task documents"""
+        task = []
+        try:
+            for document in documents:
+                task.append(document)
+                if len(task) == docs_per_task:
+                    task_queue.put(task)
+                    task = []
+            if task:
+                task_queue.put(task)
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            # the workers stop even if the corpus cannot be read to the end
+            for _ in processes:
+                task_queue.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    stats = {"documents": 0, "errors": 0, "tokens": 0}
+    start = last_report = time.perf_counter()
+    nb_running = len(processes)
+    try:
+        with open_sink(out_file) as sink:
+            while nb_running:
+                try:
+                    results = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        raise RuntimeError(
+                            "the workers stopped before the end of the corpus"
+                        )
+                    continue
+                if results is None:
+                    nb_running -= 1
+                    continue
+                if isinstance(results, str):
+                    raise RuntimeError(f"a worker stopped: {results}")
+                for doc_id, entities, nb_tokens, error in results:
+                    if error:
+                        sink.write(doc_id, entities, error=error)
+                        stats["errors"] += 1
+                    else:
+                        sink.write(doc_id, entities)
+                    stats["documents"] += 1
+                    stats["tokens"] += nb_tokens
+                if time.perf_counter() - last_report > report_every:
+                    last_report = time.perf_counter()
+                    logging.info(
+                        format_stats(compute_rates(stats, last_report - start))
+                    )
+        if feed_errors:
+            raise feed_errors[0]
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+
+    for process in processes:
+        process.join()
+    return compute_rates(stats, time.perf_counter() - start)
+
+
+def compute_rates(stats: dict, seconds: float) -> dict:
+    """add the documents and tokens per second to the stats"""
+    stats = dict(stats, seconds=seconds)
+    stats["documents_per_second"] = stats["documents"] / seconds if seconds else 0
+    stats["tokens_per_second"] = stats["tokens"] / seconds if seconds else 0
+    return stats
+
+
+def format_stats(stats: dict) -> str:
+    return (
+        f"{stats['documents']} documents ({stats['errors']} errors) in "
+        f"{stats['seconds']:.1f}s: {stats['documents_per_second']:.1f} documents/s, "
+        f"{stats['tokens_per_second']:.0f} tokens/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="tag a corpus (directory or jsonl file) with NETagger",
+    )
+    parser.add_argument("corpus", help="directory of text files or jsonl file")
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="output jsonl file (.tsv for tsv, .gz/.bz2/.xz to compress)",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "-l", "--language", help="detected for each document if not set"
+    )
+    parser.add_argument("--pattern", default="*.txt", help="files of the directory")
+    parser.add_argument("--text-field", default="text", help="text field of the jsonl")
+    parser.add_argument("--id-field", default="id", help="id field of the jsonl")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--docs-per-task", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, help="2 * workers by default")
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument(
+        "--backend",
+        default="deeppavlov",
+        choices=["deeppavlov", "quantized", "stub"],
+        help="quantized: int8 models on CPU",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    documents = read_documents(
+        args.corpus, args.pattern, text_field=args.text_field, id_field=args.id_field
+    )
+    stats = tag_corpus(
+        documents,
+        args.output,
+        workers=args.workers,
+        language=args.language,
+        batch_size=args.batch_size,
+        docs_per_task=args.docs_per_task,
+        queue_size=args.queue_size,
+        threads_per_worker=args.threads_per_worker,
+        backend=args.backend,
+    )
+    print(format_stats(stats))
+    sys.exit(1 if stats["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,48 @@
 #!/bin/python3.6
 """
+The heavy modules (spacy, deeppavlov, langdetect, tqdm, nltk) and models
+are imported and loaded on first use, importing this module is fast.
 """
+
 import inspect
+import gc
+import hashlib
 import html
+import json
 import logging
 import os
-import re
 import sys
+import threading
+import time
+import unicodedata
+import weakref
+from array import array
+from collections import OrderedDict
 
 # assert sys.version_info[:2] == (3, 6), "works only on python3.6"
 
-import spacy
-from deeppavlov import configs, build_model
-from langdetect import detect
-from tqdm import tqdm
 from unidecode import unidecode
 
+from text_utils.text_utils import common_prefix_length
+
 
 __location__ = os.path.join(
     os.getcwd(), os.path.dirname(inspect.getfile(inspect.currentframe()))
 )
 sys.path.insert(0, os.path.join(__location__, "..", "nlp_utils"))
-from nlp_utils import tokenize_into_sentences
 
 # spacy is used only for tokenization (token level)
 SPACY_MODEL = "xx_ent_wiki_sm"
-nlp_small = spacy.load(SPACY_MODEL, disable=["ner", "parser", "tagger"])
-# setting the maximum number of tokens the pipeline can support
-# (safe if ner, parser and tagger are disabled)
-nlp_small.max_length = 1_000_000_000
+# the sentences of a text are tokenized by batches of SPACY_BATCH_SIZE sentences,
+# in SPACY_N_PROCESS processes (see spacy Language.pipe())
+SPACY_BATCH_SIZE = 1000
+SPACY_N_PROCESS = 1
+# compare the text of each spacy token to the text at its offsets (slow,
+# for debugging), otherwise only the order of the offsets is checked
+CHECK_TOKEN_OFFSETS = False
+# loaded by get_nlp_small()
+_nlp_small = None
+_nlp_small_lock = threading.Lock()
 
 # List of named entities to skip
 LIST_ENT_TO_SKIP = [
@@ -45,6 +59,279 @@ LIST_ENT_TO_SKIP = [
 # replace the GPE tag to the LOC
 GPE_to_LOC = False
 
+# environment variables setting the number of threads a model uses to perform
+# on a batch (see set_intra_op_threads())
+INTRA_OP_ENV_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+]
+# environment variables setting the number of operations a model runs at once
+INTER_OP_ENV_VARIABLES = ["TF_NUM_INTEROP_THREADS"]
+
+# minimum number of characters of a sentence to detect its language
+# (see NETagger.segment_languages)
+MIN_SEGMENT_LENGTH = 20
+
+
+class NERBackend:
+    """interface of the models NETagger performs NER with (see BACKENDS)
+
+    A backend is called with a batch of sequences of tokens and returns the
+    batch and the BIO labels of the tokens, like a deepPavlov model:
+    >>> backend([["Miguel", "de", "Cervantes"], ["Madrid"]])
+        ([['Miguel', 'de', 'Cervantes'], ['Madrid']], [['B-PERSON', 'I-PERSON', 'I-PERSON'], ['B-GPE']])
+    It raises a RuntimeError if it cannot perform on a sequence. The backends
+    with a `pipe` of deepPavlov components get sequences sized with the subwords
+    of their BERT tokenizer (see SequencePacker), the other ones sequences of
+    at most `length` tokens (see NETagger.predict()).
+    A model set on a NETagger (ner_model.ner_model = backend) needs a model_key
+    naming it (its config, version...) for its labels to be cached (see LabelCache).
+    """
+
+    # name of the model in the keys of the LabelCache (None: not cached)
+    model_key = None
+
+    def __call__(self, batch: list):
+        raise NotImplementedError
+
+
+def load_deeppavlov_model(config):
+    """return the deepPavlov model built with config"""
+    from deeppavlov import build_model
+
+    return build_model(config)
+
+
+def load_quantized_model(config):
+    """return the deepPavlov model built with config, with the Linear layers of
+    its torch modules quantized to int8 (dynamic quantization, for CPU)
+
+    only the torch configs of deepPavlov (>= 1.0) can be quantized
+    """
+    try:
+        import torch
+    except ImportError as e:
+        raise ImportError("the quantized backend needs torch: pip install torch") from e
+
+    model = load_deeppavlov_model(config)
+    nb_quantized = 0
+    for component in getattr(model, "pipe", []):
+        # the pipe of a deepPavlov Chainer contains tuples (in, out, component)
+        component = component[-1]
+        module = getattr(component, "model", None)
+        if isinstance(module, torch.nn.Module):
+            component.model = torch.quantization.quantize_dynamic(
+                module.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8
+            )
+            if hasattr(component, "device"):
+                component.device = torch.device("cpu")
+            nb_quantized += 1
+    if not nb_quantized:
+        raise ValueError(f"no torch module to quantize in the model of '{config}'")
+    logging.info(f"quantized {nb_quantized} torch modules to int8")
+    return model
+
+
+# name -> function building the model of a deepPavlov config
+# (see NETagger(backend=...) and ModelRegistry.get())
+BACKENDS = {
+    "deeppavlov": load_deeppavlov_model,
+    "quantized": load_quantized_model,
+    "stub": lambda config: StubNERModel(STUB_DELAY, STUB_DELAY_PER_TOKEN),
+}
+# delays of the models of the stub backend (see StubNERModel), in seconds
+STUB_DELAY = 0.0
+STUB_DELAY_PER_TOKEN = 0.0
+
+
+class ModelRegistry:
+    """process-wide registry of the loaded deepPavlov models
+
+    The models are loaded lazily (on the first get() call) and only once:
+    all the NETagger objects using the same config and backend share the same model.
+    >>> model = MODEL_REGISTRY.get(configs.ner.ner_ontonotes_bert_mult)
+    >>> quantized_model = MODEL_REGISTRY.get(configs.ner.ner_ontonotes_bert_mult, "quantized")
+
+    If memory_budget (in bytes) is set, the least recently used models
+    are dropped from the registry when the memory used by the loaded models
+    exceeds it. The memory used by a model is estimated with the increase of the
+    resident memory of the process while building it.
+    Note that a model is only freed once no object holds a reference to it.
+
+    The number of batches a model performs on at once can be limited for all
+    the NETagger objects sharing it (see call_limit()).
+    """
+
+    def __init__(self, memory_budget: int = None):
+        self.memory_budget = memory_budget
+        # config -> model, ordered from the least to the most recently used
+        self._models = OrderedDict()
+        # config -> estimated size of the model in bytes
+        self._sizes = {}
+        # model -> (max concurrent calls, semaphore limiting the calls of the model,
+        # limits asked by other callers and ignored)
+        self._call_limits = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+
+    def __contains__(self, config):
+        return self.key(config) in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    @property
+    def memory_used(self) -> int:
+        """estimated memory used by the loaded models in bytes"""
+        return sum(self._sizes[key] for key in self._models)
+
+    @staticmethod
+    def key(config, backend="deeppavlov") -> str:
+        """return the key of the model built with config by the backend"""
+        if backend == "deeppavlov":
+            return str(config)
+        return f"{backend}:{config}"
+
+    def get(self, config, backend="deeppavlov"):
+        """return the model built with config by the backend (see BACKENDS),
+        load it if needed"""
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"unknown backend '{backend}', use one of {list(BACKENDS)}"
+            )
+        key = self.key(config, backend)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            # making room for the model if its size is known
+            self._evict(self._sizes.get(key, 0))
+            logging.info(f"loading the model with '{os.path.basename(key)}'")
+
+            memory_before = get_memory_usage()
+            model = BACKENDS[backend](config)
+            self._sizes[key] = max(get_memory_usage() - memory_before, 0)
+            logging.info(f"done loading the model ({self._sizes[key] / 2**20:.0f} MB)")
+            self._models[key] = model
+            self._evict(0, keep=key)
+            return model
+
+    def call_limit(self, model, max_concurrent_calls: int):
+        """return the semaphore limiting the number of batches the model
+        performs on at once, shared by all the callers of the model
+
+        the limit is set by the first caller, a warning is logged (once per
+        limit) when another caller asks for a different limit
+        """
+        with self._lock:
+            if model not in self._call_limits:
+                self._call_limits[model] = (
+                    max_concurrent_calls,
+                    threading.BoundedSemaphore(max_concurrent_calls),
+                    set(),
+                )
+            limit, semaphore, ignored_limits = self._call_limits[model]
+            if (
+                limit != max_concurrent_calls
+                and max_concurrent_calls not in ignored_limits
+            ):
+                ignored_limits.add(max_concurrent_calls)
+                logging.warning(
+                    f"the model is already limited to {limit} concurrent calls,"
+                    f" the limit of {max_concurrent_calls} calls is ignored"
+                )
+            return semaphore
+
+    def drop(self, config, backend="deeppavlov"):
+        """remove the model built with config by the backend from the registry"""
+        with self._lock:
+            if self._models.pop(self.key(config, backend), None) is not None:
+                logging.info(f"dropped the model '{os.path.basename(str(config))}'")
+                gc.collect()
+
+    def clear(self):
+        """remove all the models from the registry"""
+        with self._lock:
+            self._models.clear()
+            gc.collect()
+
+    def _evict(self, needed: int, keep: str = None):
+        """drop the least recently used models until needed bytes
+        fit in the memory budget"""
+        if self.memory_budget is None:
+            return
+        dropped = False
+        for key in list(self._models):
+            if self.memory_used + needed <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            logging.info(
+                f"memory budget exceeded, dropping the model '{os.path.basename(key)}'"
+            )
+            del self._models[key]
+            dropped = True
+        if dropped:
+            gc.collect()
+
+
+def get_memory_usage() -> int:
+    """return the resident memory of the process in bytes
+    (0 if it cannot be read, ie: not on Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# models shared by all the NETagger objects
+# set MODEL_REGISTRY.memory_budget (in bytes) to limit the number of loaded models
+MODEL_REGISTRY = ModelRegistry()
+
+
+class StubNERModel(NERBackend):
+    """deterministic stand-in for the deepPavlov models, to run the pipeline
+    without loading BERT (tests, benchmarks, local service)
+    >>> ner_model = NETagger(language="fr", train_model=False)
+    >>> ner_model.ner_model = StubNERModel(delay=0.05)
+
+    the tokens starting with an uppercase letter are labelled as PERSON
+    and the numbers as CARDINAL. Each call waits delay seconds,
+    plus delay_per_token seconds per token of the batch.
+    """
+
+    # the labels do not depend on the delays
+    model_key = "stub"
+
+    def __init__(self, delay=0.0, delay_per_token=0.0):
+        self.delay = delay
+        self.delay_per_token = delay_per_token
+        # number of calls and of sequences the model performed on
+        self.nb_calls = 0
+        self.nb_sequences = 0
+
+    def __call__(self, batch: list):
+        self.nb_calls += 1
+        self.nb_sequences += len(batch)
+        seconds = self.delay + self.delay_per_token * sum(map(len, batch))
+        if seconds:
+            time.sleep(seconds)
+        batch_labels = []
+        for tokens in batch:
+            labels, previous = [], "O"
+            for token in tokens:
+                if token[:1].isupper():
+                    label = "I-PERSON" if previous.endswith("PERSON") else "B-PERSON"
+                elif token.isdigit():
+                    label = "B-CARDINAL"
+                else:
+                    label = "O"
+                labels.append(label)
+                previous = label
+            batch_labels.append(labels)
+        return batch, batch_labels
+
 
 class NETagger:
     """wrapper to perform NER
@@ -53,6 +340,9 @@ class NETagger:
     and train models with
         ner_ontonotes_bert_mult: the BERT embeddings for multilingual (ie: not English)
         ner_ontonotes_bert     : the BERT embeddings for English
+    the models are loaded once per process and shared with the MODEL_REGISTRY,
+    by the backend given (see BACKENDS): "deeppavlov", "quantized" (int8 on CPU)
+    or "stub"
 
     example:
     >>> ner_model = NETagger()                # will train the model with the ner_ontonotes_bert_mult
@@ -64,20 +354,60 @@ class NETagger:
     note that some entities type will be ignored: those contained in LIST_ENT_TO_SKIP
     (CARDINAL, ORDINAL, ...)
 
+    to tag texts from several threads with the same NETagger (and model), use
+    the stateless tag() method:
+    >>> ner_model = NETagger(language="fr", intra_op_threads=2, max_concurrent_calls=4)
+    >>> with ThreadPoolExecutor(16) as executor:
+    ...     ls_entities = list(executor.map(ner_model.tag, texts))
+
     """
 
     def __init__(
         self,
-        text: str,
+        text: str = None,
         language: str = None,
         unescape_html=True,
         default_non_ent="O",
         train_model=True,
+        label_cache=None,
+        incremental=False,
+        segment_languages=False,
+        metrics=None,
+        backend="deeppavlov",
+        intra_op_threads=None,
+        max_concurrent_calls=None,
     ):
         # logging.debug(f"__init__ NETagger train_model:{train_model} with {config}")
         self.unescape_html = unescape_html
         self._default_non_ent = default_non_ent
-        self.new_text(text, language)
+        self._ner_model = None
+        # LabelCache of the labels of the sequences already tagged (None: no cache)
+        self.label_cache = label_cache
+        # if True, predict() only tags again the edited sentences of the text
+        self.incremental = incremental
+        # if True, the language of each sentence is detected, the English
+        # sentences are sent to the English model, the others to the multilingual one
+        self.segment_languages = segment_languages
+        # TaggerMetrics measuring the stages of the calls (None: not measured)
+        self.metrics = metrics
+        # name of the backend building the models (see BACKENDS)
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"unknown backend '{backend}', use one of {list(BACKENDS)}"
+            )
+        self.backend = backend
+        if intra_op_threads:
+            set_intra_op_threads(intra_op_threads)
+        # number of batches the model performs on at once (None: no limit),
+        # for all the taggers sharing the model (see ModelRegistry.call_limit()),
+        # the threads calling tag() wait for their turn
+        self.max_concurrent_calls = max_concurrent_calls
+        # (text, params, tokens, sequences, labels) of the last predict() call
+        self._tagged = None
+        self.language = language
+        if text is not None:
+            # no text is needed to use predict_many()
+            self.new_text(text, language)
 
         if train_model:
             self._train_model()
@@ -97,48 +427,82 @@ class NETagger:
             logging.error(f"exc_value: {exc_value}")
             logging.error(f"exc_traceback: {exc_traceback}")
 
-    def _train_model(self):
-        """train and store the BERT model to self.ner_model
+    @property
+    def ner_model(self):
+        """the BERT model used to perform NER on self.language
+
+        the models are loaded once and shared by all the NETagger objects
+        through the MODEL_REGISTRY, unless a model has been set
+        on the instance (ner_model.ner_model = my_model)
+        """
+        return self._get_model(self.language)
+
+    @ner_model.setter
+    def ner_model(self, model):
+        self._ner_model = model
+
+    def _get_model(self, language: str):
+        """return the BERT model used to perform NER on the language"""
+        if self._ner_model is not None:
+            return self._ner_model
+        return MODEL_REGISTRY.get(self._model_config(language), self.backend)
+
+    def _model_key(self, language: str) -> str:
+        """return the key identifying the model used for the language
+        (the sequences with the same key can be sent to the model together)
+
+        the key of a model set on the tagger is its model_key (see NERBackend),
+        or its type and id if it has none (its labels are then not cached)
+        """
+        if self._ner_model is not None:
+            model_key = getattr(self._ner_model, "model_key", None)
+            if model_key is not None:
+                return str(model_key)
+            model_type = type(self._ner_model)
+            name = f"{model_type.__module__}.{model_type.__qualname__}"
+            return f"{name}@{id(self._ner_model):x}"
+        return MODEL_REGISTRY.key(self._model_config(language), self.backend)
+
+    def _model_config(self, language: str = None):
+        """return the deepPavlov config of the BERT model used for the language
 
         BERT model used:
             * ner_ontonotes_bert_mult of other language than English
             * ner_ontonotes_bert for English
 
+        the stub backend does not build its models from the configs, the name
+        of the config is returned without importing deeppavlov
         """
+        if self.backend == "stub":
+            if (language or self.language) == "en":
+                return "ner_ontonotes_bert"
+            return "ner_ontonotes_bert_mult"
+
+        from deeppavlov import configs
 
-        if self.language == "en":
-            # training the model with ner_ontonotes_bert
-            logging.info(f"loading the model with 'ner_ontonotes_bert'")
-            # obsolete
-            self.ner_model = build_model(configs.ner.ner_ontonotes_bert)
-            # self.ner_model = build_model(configs.ner.ner_ontonotes_bert_torch)
+        if (language or self.language) == "en":
+            return configs.ner.ner_ontonotes_bert
+            # return configs.ner.ner_ontonotes_bert_torch
 
         # elif self.language == "ru":
         # the ner_rus_bert model is
         # not working on my pc as the model is too heavy
         # does not work well as the model only contains 4 entity types (not WOA)
-        # training the model with ner_rus_bert
-        # logging.info(f"training the model with 'ner_rus_bert'")
-        # self.ner_model = build_model(configs.ner.ner_rus_bert)
-        else:
-            #  training the model with ner_ontonotes_bert_mult
-            logging.info(f"loading the model with 'ner_ontonotes_bert_mult'")
-            # obsolete
-            self.ner_model = build_model(configs.ner.ner_ontonotes_bert_mult)
-            # self.ner_model = build_model(configs.ner.ner_ontonotes_bert_torch)
-        logging.info("done loading the model")
+        # return configs.ner.ner_rus_bert
+        return configs.ner.ner_ontonotes_bert_mult
+        # return configs.ner.ner_ontonotes_bert_torch
+
+    def _train_model(self):
+        """load the BERT model of self.language in the MODEL_REGISTRY
+
+        the model is only loaded if no other NETagger object loaded it before
+        """
+        MODEL_REGISTRY.get(self._model_config(), self.backend)
 
     def new_text(self, text: str, language: str = None):
         """replace the old text with a new one"""
         logging.debug(f"replacing the text with a new one")
-        assert isinstance(
-            text, str
-        ), f"text type should be a string, not a {type(text)}"
-        assert len(text), "text is empty"
-        if len(text) > 100000:
-            logging.warning(
-                f"text is long ({len(text)} characters), performing NER on it could cause warnings"
-            )
+        check_text(text)
         if self.unescape_html:
             logging.info("unescaping the html entities")
         self.text = html.unescape(text) if self.unescape_html else text
@@ -148,215 +512,1422 @@ class NETagger:
 
         self.text = text
         if not language:
-            language = detect(text).split("-")[0]
+            language = detect_language(text)
         self.language = language
 
-    def predict(self, length=250):
+    def predict(self, length=250, batch_size=32, pack_sentences=True):
         """
         tokenize, perform NER on the self.text attribute, and update self.lis_entities
 
-        BERT models cannot perform on more than 250 tokens. Tried to modify this in the
-        deeppavlov settings, and couldn't make it work.
+        BERT models cannot perform on more than 512 subwords (max_seq_length of the
+        deeppavlov configs), a RuntimeError is raised otherwise.
 
         The workaround proposed is: tokenizing the text into sentences,
-        then tokenizing the sentence and run the bert on chunks of theses tokens.
+        then tokenizing the sentence and run the bert on sequences of theses tokens
+        (see SequencePacker): the short sentences are packed in the same sequence
+        (unless pack_sentences is False) and the long sentences are split, so that
+        the sequences do not exceed the number of subwords of the model.
+        If the subwords cannot be counted, the sequences are of at most length tokens.
         Note that a sliding window approach could have been proposed but requires
         too much time.
 
+        The chunks of tokens are sent to the model by batches of batch_size
+        sequences of similar lengths (see NETagger._infer()).
+        Use batch_size=1 to perform NER chunk by chunk.
+
         TOKENIZING THE SENTENCE works best with nltk's sent_tokenize compared to
         spacy and sentence_splitter, because those 2 modules take the \\n as sentence boundaries.
 
         TOKENIZING THE TEXT INTO TOKENS works better with spacy
+
+        If the tagger is incremental (NETagger(incremental=True)), only the
+        sentences edited since the previous call are tagged again (see
+        NETagger._retag()).
         """
-        if not hasattr(self, "ner_model"):
-            self._train_model()
         if not hasattr(self, "text"):
             raise ValueError("no text to tag")
+        if self.metrics is not None:
+            self.metrics.start_call(nb_documents=1)
 
-        ls_tokens, labels = [], []
+        params = (
+            self.language,
+            length,
+            pack_sentences,
+            self.segment_languages,
+            self._model_key(self.language),
+        )
+        if self.incremental and self._tagged is not None and self._tagged[1] == params:
+            tokens, sequences, labels = self._retag(self.text, batch_size)
+        else:
+            tokens, sequences = self._tokenize(
+                self.text, self.language, length, pack_sentences
+            )
+            documents = [(self.text, self.language, tokens, sequences)]
+            labels = self._label_documents(documents, batch_size)[0]
+        if self.incremental:
+            self._tagged = (self.text, params, tokens, sequences, labels)
+        return self._decode(self.text, tokens, labels)
 
-        # tokenizing into sentences and getting their span
-        last_sentence_index = 0
-        sentences = tokenize_into_sentences(self.text, self.language)
+    def tag(
+        self,
+        text: str,
+        language: str = None,
+        length=250,
+        batch_size=32,
+        pack_sentences=True,
+    ) -> list:
+        """return the entities of the text (see NETagger.predict())
+
+        The tagger is not modified (self.text is neither used nor replaced), so
+        tag() can be called from several threads at once on the same NETagger:
+        the threads share the model, at most self.max_concurrent_calls batches
+        are sent to it at once (by all the taggers sharing it). The language is self.language if not given,
+        detected on the text otherwise.
+        """
+        check_text(text)
+        language = language or self.language or detect_language(text)
+        if self.metrics is not None:
+            self.metrics.start_call(nb_documents=1)
+        tokens, sequences = self._tokenize(text, language, length, pack_sentences)
+        documents = [(text, language, tokens, sequences)]
+        labels = self._label_documents(documents, batch_size)[0]
+        return self._decode(text, tokens, labels)
+
+    def _retag(self, text: str, batch_size=32):
+        """return the (tokens, sequences, labels) of the text, only the sequences
+        of the previous text (self._tagged) that were edited are tagged again
+
+        The text is compared to the previous one: the sequences in the common
+        prefix and in the common suffix are kept (their offsets are shifted), the
+        text between them is tokenized and tagged. The sequences next to the edit
+        are tagged again as well, as the sentence boundaries may have changed.
+        """
+        old_text, params, old_tokens, old_sequences, old_labels = self._tagged
+        language, length, pack_sentences = params[:3]
+        if old_text == text:
+            return old_tokens, old_sequences, old_labels
+        prefix = common_prefix_length(old_text, text)
+        suffix = min(
+            common_prefix_length(old_text, text, reverse=True),
+            len(old_text) - prefix,
+            len(text) - prefix,
+        )
+        # number of sequences kept before and after the edit
+        nb_before = 0
+        while (
+            nb_before < len(old_sequences)
+            and old_tokens.ends[old_sequences[nb_before][-1][1] - 1] <= prefix
+        ):
+            nb_before += 1
+        nb_before = max(nb_before - 1, 0)
+        # the sequences ending inside a sentence (split sentence, see
+        # SequencePacker._split()) are followed by the next piece of the sentence
+        while (
+            nb_before
+            and old_sequences[nb_before - 1][-1][1] == old_sequences[nb_before][0][0]
+        ):
+            nb_before -= 1
+        nb_after = 0
+        while (
+            nb_after < len(old_sequences) - nb_before
+            and old_tokens.starts[old_sequences[-nb_after - 1][0][0]]
+            >= len(old_text) - suffix
+        ):
+            nb_after += 1
+        nb_after = max(nb_after - 1, 0)
+        while (
+            nb_after
+            and old_sequences[-nb_after][0][0] == old_sequences[-nb_after - 1][-1][1]
+        ):
+            nb_after -= 1
+
+        # the tokens [0:kept_before] and [kept_after:] of the old text are kept
+        kept_before = old_sequences[nb_before - 1][-1][1] if nb_before else 0
+        kept_after = old_sequences[-nb_after][0][0] if nb_after else len(old_tokens)
+        shift = len(text) - len(old_text)
+        start = old_tokens.ends[kept_before - 1] if kept_before else 0
+        end = old_tokens.starts[kept_after] + shift if nb_after else len(text)
+        logging.info(f"tagging again {end - start} characters of {len(text)}")
+
+        tokens = TokenStore(text)
+        tokens.starts = old_tokens.starts[:kept_before]
+        tokens.ends = old_tokens.ends[:kept_before]
+        labels = old_labels[:kept_before]
+        sequences = old_sequences[:nb_before]
+        tokens.languages = {
+            index: sequence_language
+            for index, sequence_language in old_tokens.languages.items()
+            if index < kept_before
+        }
+        if start:
+            # the sentences tokenizer would keep the spaces at the start of the
+            # edited text in its first sentence, they are a token between sentences
+            nb_spaces = len(text[start:end]) - len(text[start:end].lstrip())
+            if nb_spaces:
+                tokens.append(start, start + nb_spaces)
+                labels.append(LABELS.id(self._default_non_ent))
+                start += nb_spaces
+        edited = text[start:end]
+        if edited:
+            edited_tokens, edited_sequences = self._tokenize(
+                edited, language, length, pack_sentences
+            )
+            edited_labels = self._label_documents(
+                [(edited, language, edited_tokens, edited_sequences)], batch_size
+            )[0]
+            sequences += shift_sequences(edited_sequences, len(tokens))
+            for index, sequence_language in edited_tokens.languages.items():
+                tokens.languages[index + len(tokens)] = sequence_language
+            tokens.starts += shift_offsets(edited_tokens.starts, start)
+            tokens.ends += shift_offsets(edited_tokens.ends, start)
+            labels += edited_labels
+        if nb_after and (tokens.ends[-1] if len(tokens) else 0) < end:
+            # the text between the last edited sentence and the kept sentences
+            tokens.append(tokens.ends[-1] if len(tokens) else 0, end)
+            labels.append(LABELS.id(self._default_non_ent))
+        sequences += shift_sequences(
+            old_sequences[len(old_sequences) - nb_after :], len(tokens) - kept_after
+        )
+        for index, sequence_language in old_tokens.languages.items():
+            if index >= kept_after:
+                tokens.languages[index + len(tokens) - kept_after] = sequence_language
+        tokens.starts += shift_offsets(old_tokens.starts[kept_after:], shift)
+        tokens.ends += shift_offsets(old_tokens.ends[kept_after:], shift)
+        labels += old_labels[kept_after:]
+        return tokens, sequences, labels
+
+    def predict_iter(self, length=250, batch_size=32, pack_sentences=True):
+        """same as NETagger.predict(), but yield the entities as soon as they are found
+
+        The text is tagged by groups of sentences making about batch_size
+        sequences, so the first entities are available before the end of the text
+        and the memory used does not depend on the length of the text.
+        >>> for entity in ner_model.predict_iter():
+        ...     print(entity)
+        """
+        if not hasattr(self, "text"):
+            raise ValueError("no text to tag")
+        if self.metrics is not None:
+            self.metrics.start_call(nb_documents=1)
+
+        decoder = EntityDecoder(self.text)
+        for tokens, sequences in self._iter_tokenize(
+            self.text, self.language, length, pack_sentences, max_sequences=batch_size
+        ):
+            documents = [(self.text, self.language, tokens, sequences)]
+            labels = self._label_documents(documents, batch_size)[0]
+            yield from self._measure("decode", decoder.feed, tokens, labels)
+        yield from self._measure("decode", decoder.close)
+
+    def predict_many(
+        self,
+        texts,
+        language=None,
+        length=250,
+        batch_size=32,
+        max_sequences=1024,
+        pack_sentences=True,
+    ):
+        """perform NER on an iterable of texts and yield their list of entities
+        in the same order as the texts
+
+        The chunks of tokens of several texts are sent to the model in the same batches:
+        the texts are read by groups of about max_sequences chunks of tokens,
+        so that the memory used does not depend on the number of texts.
+        The language of each text is detected if language is not given.
+        >>> ner_model = NETagger()
+        >>> for entities in ner_model.predict_many(open("news.txt")):
+        ...     print(entities)
+        """
+        if self.metrics is not None:
+            self.metrics.start_call()
+        documents, nb_sequences = [], 0
+        for text in texts:
+            check_text(text)
+            if self.metrics is not None:
+                self.metrics.count("documents")
+            text_language = language or detect_language(text)
+            tokens, sequences = self._tokenize(
+                text, text_language, length, pack_sentences
+            )
+            documents.append((text, text_language, tokens, sequences))
+            nb_sequences += len(sequences)
+            if nb_sequences >= max_sequences:
+                yield from self._predict_documents(documents, batch_size)
+                documents, nb_sequences = [], 0
+        if documents:
+            yield from self._predict_documents(documents, batch_size)
 
+    def _predict_documents(self, documents: list, batch_size=32):
+        """perform NER on the tokenized documents [(text, language, tokens, sequences), ...]
+        and yield their list of entities (see NETagger._tokenize() for the sequences)
+        """
+        ls_labels = self._label_documents(documents, batch_size)
+        for (text, _, tokens, _), labels in zip(documents, ls_labels):
+            yield self._decode(text, tokens, labels)
+
+    def _label_documents(self, documents: list, batch_size=32) -> list:
+        """perform NER on the tokenized documents [(text, language, tokens, sequences), ...]
+        and return the label ids of the tokens of each document (see LABELS)
+
+        the sequences of the documents using the same model are batched together
+        """
         logging.info("tagging the entities")
+        sequences = [
+            (doc_index, ranges)
+            for doc_index, (_, _, _, doc_sequences) in enumerate(documents)
+            for ranges in doc_sequences
+        ]
+        seq_labels = self._label_sequences(
+            [
+                (
+                    documents[doc_index][2].languages.get(
+                        ranges[0][0], documents[doc_index][1]
+                    ),
+                    documents[doc_index][2],
+                    ranges,
+                )
+                for doc_index, ranges in sequences
+            ],
+            batch_size,
+        )
+
+        # the tokens between sentences are not sent to the model
+        # and are labelled as non entities
+        non_ent = LABELS.id(self._default_non_ent)
+        ls_labels = [
+            array("H", [non_ent]) * len(tokens) for _, _, tokens, _ in documents
+        ]
+        for (doc_index, ranges), seq_label in zip(sequences, seq_labels):
+            for start, end in ranges:
+                ls_labels[doc_index][start:end] = seq_label[: end - start]
+                seq_label = seq_label[end - start :]
+        return ls_labels
+
+    def _label_sequences(self, sequences: list, batch_size=32) -> list:
+        """perform NER on the sequences [(language, tokens, ranges), ...]
+        and return the label ids (see LABELS) of the tokens of each sequence
+
+        tokens is a TokenStore and ranges the (start, end) indexes of the
+        sequence in tokens (see SequencePacker.pack()).
+        The sequences using the same model are batched together.
+        If self.label_cache is set, the model only performs on the sequences
+        that are not in the cache (once per distinct sequence).
+        """
+        # grouping the sequences by model
+        sequences_by_model = {}
+        for index, (language, _, _) in enumerate(sequences):
+            key = self._model_key(language)
+            sequences_by_model.setdefault(key, (language, []))[1].append(index)
+
+        ls_labels = [None for _ in sequences]
+        for model_key, (language, indexes) in sequences_by_model.items():
+            seq_tokens = [
+                [
+                    token
+                    for start, end in sequences[index][2]
+                    for token in sequences[index][1].texts(start, end)
+                ]
+                for index in indexes
+            ]
+            # the positions in indexes of the sequences to send to the model
+            if self.label_cache is None:
+                to_infer = list(range(len(indexes)))
+            elif (
+                self._ner_model is not None
+                and getattr(self._ner_model, "model_key", None) is None
+            ):
+                raise ValueError(
+                    "the labels of a model set on the tagger are only cached with"
+                    " its model_key, set it to name the model (see NERBackend)"
+                )
+            else:
+                cache_keys = [
+                    self.label_cache.key(model_key, sequences[index][0], tokens)
+                    for index, tokens in zip(indexes, seq_tokens)
+                ]
+                # cache key -> positions of the sequences not cached
+                missing = OrderedDict()
+                for i, labels in enumerate(self.label_cache.get_many(cache_keys)):
+                    if labels is None:
+                        missing.setdefault(cache_keys[i], []).append(i)
+                    else:
+                        ls_labels[indexes[i]] = labels
+                # the same sequence is only sent once to the model
+                duplicates = list(missing.values())
+                to_infer = [positions[0] for positions in duplicates]
+            if not to_infer:
+                continue
+
+            seq_labels = self._measure(
+                "inference",
+                self._infer,
+                [seq_tokens[i] for i in to_infer],
+                batch_size=batch_size,
+                ner_model=self._get_model(language),
+            )
+            for i, seq_label in zip(to_infer, seq_labels):
+                nb_tokens = len(seq_tokens[i])
+                assert len(seq_label) == nb_tokens, f"{nb_tokens}\t{len(seq_label)}"
+                ls_labels[indexes[i]] = LABELS.ids(seq_label)
+            if self.label_cache is not None:
+                self.label_cache.put_many(
+                    (cache_keys[i], ls_labels[indexes[i]]) for i in to_infer
+                )
+                for positions in duplicates:
+                    for i in positions[1:]:
+                        ls_labels[indexes[i]] = ls_labels[indexes[positions[0]]]
+        return ls_labels
+
+    def _decode(self, text: str, tokens, labels: array) -> list:
+        """return the list of entities of the text from its labelled tokens
+
+        tokens is a TokenStore, labels are the ids (see LABELS) of BIO labels
+        (B-PERSON, I-PERSON, O, ...)
+        """
+        decoder = EntityDecoder(text)
+        return self._measure(
+            "decode", lambda: decoder.feed(tokens, labels) + decoder.close()
+        )
+
+    def _measure(self, stage: str, function, *args, **kwargs):
+        """return function(*args, **kwargs), its time is added to the stage
+        of self.metrics if set (see TaggerMetrics)"""
+        if self.metrics is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.metrics.add_time(stage, time.perf_counter() - start)
+
+    def _tokenize(self, text: str, language: str, length=250, pack_sentences=True):
+        """tokenize the text into sentences, and the sentences into tokens
+
+        return a tuple (tokens, sequences) where
+            tokens is the TokenStore of the tokens of the text,
+                the spans between the sentences are kept as tokens
+            sequences is the list of the sequences of tokens the NER is performed on,
+                a sequence is a list of (start, end) indexes in tokens
+                (see SequencePacker.pack())
+        """
+        return next(self._iter_tokenize(text, language, length, pack_sentences))
+
+    def _iter_tokenize(
+        self,
+        text: str,
+        language: str,
+        length=250,
+        pack_sentences=True,
+        max_sequences=None,
+    ):
+        """same as NETagger._tokenize(), but yield the (tokens, sequences) of groups
+        of consecutive sentences making about max_sequences sequences
+        (a single group for the whole text if max_sequences is None)
+
+        the indexes of the sequences refer to the tokens of their group
+        """
+        from nlp_utils import tokenize_into_sentences
+        from spacy.attrs import IDX, LENGTH
 
-        for sent_start, sent_end in tqdm(sentences):
-            sentence = self.text[sent_start:sent_end]
+        nlp_small = get_nlp_small()
+        packer = get_sequence_packer(self._get_model(language))
+        max_length = packer.max_length(length)
+        tokens, ls_sentences, group_length = TokenStore(text), [], 0
+        # language of the sentences (only if self.segment_languages)
+        sentence_languages = []
+
+        # tokenizing into sentences and getting their span
+        last_sentence_index = 0
+        sentences = self._measure("sentences", tokenize_into_sentences, text, language)
+
+        logging.info("tokenizing the sentences")
+        # tokenizing tokens using the SPACY_MODEL
+        docs = nlp_small.pipe(
+            (text[sent_start:sent_end] for sent_start, sent_end in sentences),
+            batch_size=SPACY_BATCH_SIZE,
+            n_process=SPACY_N_PROCESS,
+        )
+        if self.metrics is not None:
+            docs = self.metrics.timed("spacy", docs)
+        for (sent_start, sent_end), doc in zip(sentences, docs):
             if last_sentence_index != sent_start:
                 # The tokenization of sentences does not keep spaces
                 # we need to reconstruct the missing tokens from the text
-                # we label those empty tokens as 'O' (no entity)
-                ls_tokens.append(
-                    {
-                        "token": self.text[last_sentence_index:sent_start],
-                        "position": (last_sentence_index, sent_start),
-                        "trailing_whitespace": "",
-                    }
-                )
-                labels.append(self._default_non_ent)
+                # those tokens will be labelled as 'O' (no entity)
+                tokens.append(last_sentence_index, sent_start)
             last_sentence_index = sent_end
 
-            # tokenizing tokens using the SPACY_MODEL
-            tokens = [
-                {
-                    "token": tok.text,
-                    "position": (tok.idx + sent_start, tok.idx + len(tok) + sent_start),
-                    "trailing_whitespace": tok.whitespace_,  # Trailing space character if present.
-                }
-                for tok in nlp_small(sentence)
-            ]
+            sent_tokens_start = len(tokens)
+            offsets = doc.to_array([IDX, LENGTH]).astype("l")
+            starts = offsets[:, 0] + sent_start
+            tokens.extend(starts, starts + offsets[:, 1])
+            if CHECK_TOKEN_OFFSETS:
+                # checking no mistake has been made while computing the token positions
+                assert [tok.text for tok in doc] == tokens.texts(
+                    sent_tokens_start, len(tokens)
+                ), f"wrong token offsets in the sentence {sent_start}:{sent_end}"
+            ls_sentences.append((sent_tokens_start, len(tokens)))
+            if self.segment_languages:
+                sentence_languages.append(
+                    self._sentence_language(
+                        text[sent_start:sent_end],
+                        language,
+                        sentence_languages[-1] if sentence_languages else language,
+                    )
+                )
 
-            # checking no mistake has been made while computing the token positions
-            for tok in tokens:
-                assert (
-                    tok["token"] == self.text[tok["position"][0] : tok["position"][1]]
+            if max_sequences is None:
+                continue
+            group_length += sum(
+                packer.token_length(token)
+                for token in tokens.texts(sent_tokens_start, len(tokens))
+            )
+            if (
+                len(ls_sentences) >= max_sequences
+                or group_length >= max_sequences * max_length
+            ):
+                check_token_offsets(tokens)
+                # getting the sequences of tokens to perform NER on them
+                yield tokens, self._pack(
+                    packer,
+                    tokens,
+                    ls_sentences,
+                    sentence_languages,
+                    language,
+                    length,
+                    pack_sentences,
                 )
+                tokens, ls_sentences, group_length = TokenStore(text), [], 0
+                sentence_languages = []
+
+        if len(tokens) or max_sequences is None:
+            check_token_offsets(tokens)
+            yield tokens, self._pack(
+                packer,
+                tokens,
+                ls_sentences,
+                sentence_languages,
+                language,
+                length,
+                pack_sentences,
+            )
+
+    def _pack(
+        self,
+        packer,
+        tokens,
+        sentences: list,
+        sentence_languages: list,
+        language: str,
+        length=250,
+        pack_sentences=True,
+    ) -> list:
+        """return the sequences of the sentences (see SequencePacker.pack())
+
+        if the languages of the sentences are given, the language of the
+        sequences that differs from the language of the text is kept
+        in tokens.languages
+        """
+        sequences = self._measure(
+            "packing",
+            packer.pack,
+            tokens,
+            sentences,
+            length,
+            pack_sentences,
+            sentence_languages,
+        )
+        if self.metrics is not None:
+            # the sentences that are not a single range of a sequence are split
+            ranges = {range_ for ranges in sequences for range_ in ranges}
+            self.metrics.count("sentences", len(sentences))
+            self.metrics.count("tokens", len(tokens))
+            self.metrics.count("sequences", len(sequences))
+            self.metrics.count(
+                "split_sentences",
+                sum(sentence not in ranges for sentence in sentences),
+            )
+        if sentence_languages:
+            # the sequences only contain sentences of the same language
+            i = 0
+            for ranges in sequences:
+                while sentences[i][1] <= ranges[0][0]:
+                    i += 1
+                if sentence_languages[i] != language:
+                    tokens.languages[ranges[0][0]] = sentence_languages[i]
+        return sequences
+
+    def _sentence_language(self, sentence: str, language: str, previous: str) -> str:
+        """return the language of the model the sentence is sent to
+        (see NETagger.segment_languages)
+
+        the English sentences are sent to the English model and the other
+        sentences to the multilingual model, the sentences too short to detect
+        their language are sent to the same model as the previous sentence
+        """
+        from langdetect.lang_detect_exception import LangDetectException
 
-            # getting chunks of tokens and performing NER on them
-            for tokseq_number, tok_seq in enumerate(chunks(tokens, length), start=1):
-                # small_ls_tokens = [tok["token"] for tok in tok_seq]
-                if tokseq_number > 1:
+        if len(sentence) < MIN_SEGMENT_LENGTH:
+            return previous
+        try:
+            # the languages of the sentences are not cached, they would evict
+            # the languages of the texts
+            detected = detect_language(sentence, cache=False)
+        except LangDetectException:
+            return previous
+        if detected == "en":
+            return "en"
+        return detected if language == "en" else language
+
+    def _infer(self, sequences: list, batch_size=32, ner_model=None) -> list:
+        """perform NER on a list of token sequences and return their labels
+
+        The sequences are sorted by length and sent to the model
+        by batches of batch_size sequences, so that the sequences of a batch
+        have similar lengths (less padding).
+        The labels are returned in the same order as the sequences:
+        >>> ner_model._infer([["Miguel", "de", "Cervantes"], ["Madrid"]])
+            [['B-PERSON', 'I-PERSON', 'I-PERSON'], ['B-GPE']]
+        ner_model is self.ner_model if not given
+        """
+        from tqdm import tqdm
+
+        if ner_model is None:
+            ner_model = self.ner_model
+        labels = [None for _ in sequences]
+        # bucketing the sequences by length
+        order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+        batches = list(chunks(order, batch_size))
+        for batch in tqdm(batches, disable=len(batches) < 2):
+            batch_tokens = [sequences[i] for i in batch]
+            if self.metrics is not None:
+                self.metrics.count("model_batches")
+            try:
+                res = self._call_model(ner_model, batch_tokens)
+            except RuntimeError as e:
+                if self.metrics is not None:
+                    self.metrics.count("failed_batches")
+                if len(batch) == 1:
+                    batch_labels = [self._failed_sequence_labels(batch_tokens[0], e)]
+                else:
+                    # the error is caused by one (or more) sequences of the batch
+                    # performing NER sequence by sequence to isolate it
                     logging.warning(
-                        f"SENTENCE TOO LONG ---"
-                        + unidecode(sentence.replace("\n", "\\n"))[:100]
-                        + "... (CONVERTED TO ASCII)"
+                        f"error while performing NER on a batch of {len(batch)} sequences,"
+                        " performing NER sequence by sequence"
                     )
-                    # logging.warning(f"TOKENS ARE ---{tokens[:10]} ... ---")
-                try:
-                    res = self.ner_model([[tok["token"] for tok in tok_seq]])
-                    # raise RuntimeError('raising the error for testing')
-                except RuntimeError as e:
-                    # if a RuntimeError occurs it can be caused
-                    # by a huge proportion of non letter tokens
-                    # eg: ['A&lt;^ft.i-', 'j', '-', 'j^^', '\n\n', '/4*.&gt;-&lt;U-', 'rf', '-', 'U', ',', '\n\n'
-                    # will ignore this sequence
-                    logging.error(e)
-                    logging.error(
-                        f"list of tokens that ner is performed is: "
-                        + unidecode(str(tok_seq))
-                    )
-                    logging.error(
-                        f"will label those tokens as 'not named entities' using '{self._default_non_ent}'"
-                    )
-                    labels += [self._default_non_ent for _ in tok_seq]
+                    batch_labels = [
+                        self._infer_sequence(ner_model, tokens)
+                        for tokens in batch_tokens
+                    ]
+            else:
+                batch_labels = res[1]
+            for i, seq_labels in zip(batch, batch_labels):
+                labels[i] = list(seq_labels)
+        return labels
+
+    def _infer_sequence(self, ner_model, tokens: list) -> list:
+        """perform NER on a single sequence of tokens and return its labels"""
+        try:
+            return list(self._call_model(ner_model, [tokens])[1][0])
+        except RuntimeError as e:
+            return self._failed_sequence_labels(tokens, e)
+
+    def _call_model(self, ner_model, batch: list):
+        """return ner_model(batch), waiting if max_concurrent_calls batches
+        are already being tagged by the model"""
+        if not self.max_concurrent_calls:
+            return ner_model(batch)
+        with MODEL_REGISTRY.call_limit(ner_model, self.max_concurrent_calls):
+            return ner_model(batch)
+
+    def _failed_sequence_labels(self, tokens: list, error: RuntimeError) -> list:
+        """label as non entities the tokens the model failed to perform on"""
+        if self.metrics is not None:
+            self.metrics.count("failed_sequences")
+        # if a RuntimeError occurs it can be caused
+        # by a huge proportion of non letter tokens
+        # eg: ['A&lt;^ft.i-', 'j', '-', 'j^^', '\n\n', '/4*.&gt;-&lt;U-', 'rf', '-', 'U', ',', '\n\n'
+        # will ignore this sequence
+        logging.error(error)
+        logging.error(
+            f"list of tokens that ner is performed is: " + unidecode(str(tokens))
+        )
+        logging.error(
+            f"will label those tokens as 'not named entities' using '{self._default_non_ent}'"
+        )
+        return [self._default_non_ent for _ in tokens]
+
+
+class TaggerMetrics:
+    """timings of the stages and counters of the calls of a NETagger
+    >>> metrics = TaggerMetrics()
+    >>> ner_model = NETagger(text, metrics=metrics)
+    >>> entities = ner_model.predict()
+    >>> metrics.last["seconds"]  # the stages of the last call
+        {'sentences': 0.01, 'spacy': 0.04, 'packing': 0.002, 'inference': 1.3, 'decode': 0.001}
+    >>> metrics.last["counts"]
+        {'calls': 1, 'documents': 1, 'sentences': 12, 'tokens': 310, 'sequences': 2, ...}
+    >>> print(metrics.to_prometheus())
+
+    The totals since the creation (or the last reset()) are in metrics.seconds and
+    metrics.counts. The sequences are the chunks of tokens sent to the model,
+    the split sentences the sentences too long for a single sequence, the failed
+    batches and sequences the ones the model raised a RuntimeError on.
+    When the metrics of a NETagger are not set, nothing is measured.
+    """
+
+    STAGES = ("sentences", "spacy", "packing", "inference", "decode")
+    COUNTERS = (
+        "calls",
+        "documents",
+        "sentences",
+        "tokens",
+        "sequences",
+        "split_sentences",
+        "model_batches",
+        "failed_batches",
+        "failed_sequences",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """set the timings and the counters to 0"""
+        with self._lock:
+            self.seconds = dict.fromkeys(self.STAGES, 0.0)
+            self.counts = dict.fromkeys(self.COUNTERS, 0)
+            self.last = self._new_call()
+
+    def start_call(self, nb_documents=0):
+        """start the measures of a new call (predict(), predict_many(), ...)"""
+        with self._lock:
+            self.last = self._new_call()
+        self.count("calls")
+        self.count("documents", nb_documents)
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.last["seconds"][stage] += seconds
+
+    def count(self, counter: str, number=1):
+        with self._lock:
+            self.counts[counter] += number
+            self.last["counts"][counter] += number
+
+    def timed(self, stage: str, iterable):
+        """yield the items of iterable, the time to get them is added to the stage"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "seconds": dict(self.seconds),
+                "counts": dict(self.counts),
+                "last": {key: dict(values) for key, values in self.last.items()},
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self, prefix="netagger") -> str:
+        """return the totals in the Prometheus text exposition format"""
+        metrics = self.to_dict()
+        lines = [
+            f"# HELP {prefix}_stage_seconds_total time spent in each stage",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ]
+        for stage, seconds in metrics["seconds"].items():
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {seconds}')
+        for counter, count in metrics["counts"].items():
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            lines.append(f"{prefix}_{counter}_total {count}")
+        return "\n".join(lines) + "\n"
+
+    def _new_call(self) -> dict:
+        return {
+            "seconds": dict.fromkeys(self.STAGES, 0.0),
+            "counts": dict.fromkeys(self.COUNTERS, 0),
+        }
+
+
+class LabelVocabulary:
+    """mapping between the labels of the model (B-PERSON, I-PERSON, O, ...)
+    and the integer ids used to store them in arrays
+    >>> LABELS.id("B-PERSON")
+        1
+    >>> LABELS[1]
+        'B-PERSON'
+    """
+
+    def __init__(self, labels=("O",)):
+        self.labels = []
+        self._ids = {}
+        for label in labels:
+            self.id(label)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, label_id: int) -> str:
+        return self.labels[label_id]
+
+    def id(self, label: str) -> int:
+        """return the id of the label (a new id if the label is unknown)"""
+        try:
+            return self._ids[label]
+        except KeyError:
+            with _labels_lock:
+                if label not in self._ids:
+                    self._ids[label] = len(self.labels)
+                    self.labels.append(label)
+            return self._ids[label]
+
+    def ids(self, labels) -> array:
+        """return the array of the ids of the labels"""
+        return array("H", [self.id(label) for label in labels])
+
+
+_labels_lock = threading.Lock()
+# labels of all the models
+LABELS = LabelVocabulary()
+
+
+class LabelCache:
+    """cache of the labels predicted for the sequences of tokens
+
+    The labels are stored by the hash of (model, language, tokens of the sequence),
+    so the sequences repeated in the texts (boilerplate, footers, ...) are only sent
+    once to the model, and get the same labels as if they had been sent again:
+    >>> ner_model = NETagger(label_cache=LabelCache(path="labels.sqlite"))
+
+    The max_size most recently used sequences are kept in memory. If path is set,
+    all the labels are also stored in a sqlite database, so they are kept across
+    runs. Note that the sequences are made of packed sentences (see
+    SequencePacker.pack()): use pack_sentences=False to cache single sentences.
+    """
+
+    def __init__(self, max_size=100_000, path: str = None):
+        self.max_size = max_size
+        self.path = path
+        # key -> label ids, ordered from the least to the most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if path is not None:
+            import sqlite3
+
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, labels TEXT)"
+            )
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(model_key: str, language: str, tokens: list) -> str:
+        """return the key of the sequence of tokens"""
+        content = "\x1e".join([str(model_key), str(language), "\x1f".join(tokens)])
+        return hashlib.sha1(content.encode("UTF-8", "surrogatepass")).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        """hits (in memory or on disk) and misses of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self),
+        }
+
+    def get_many(self, keys: list) -> list:
+        """return the label ids of the keys (None for the keys not cached)"""
+        with self._lock:
+            ls_labels = []
+            for key in keys:
+                labels = self._entries.get(key)
+                if labels is not None:
+                    self._entries.move_to_end(key)
+                elif self._db is not None:
+                    labels = self._read(key)
+                    if labels is not None:
+                        self.disk_hits += 1
+                        self._store(key, labels)
+                if labels is None:
+                    self.misses += 1
                 else:
-                    labels += [anno for anno in res[1][0]]
-                ls_tokens += tok_seq
+                    self.hits += 1
+                ls_labels.append(labels)
+            return ls_labels
+
+    def put_many(self, items):
+        """store the (key, label ids) items"""
+        with self._lock:
+            items = list(items)
+            for key, labels in items:
+                self._store(key, labels)
+            if self._db is not None and items:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO labels VALUES (?, ?)",
+                    [
+                        (key, " ".join(LABELS[label_id] for label_id in labels))
+                        for key, labels in items
+                    ],
+                )
+                self._db.commit()
+
+    def clear(self):
+        """remove the labels from the memory (not from the disk)"""
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        """close the database"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _read(self, key: str) -> array:
+        """return the label ids stored on disk for the key"""
+        row = self._db.execute(
+            "SELECT labels FROM labels WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        # the ids of the labels are not the same from one run to another
+        return LABELS.ids(row[0].split(" ") if row[0] else [])
+
+    def _store(self, key: str, labels: array):
+        """store the labels in memory, drop the least recently used ones"""
+        self._entries[key] = labels
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class TokenStore:
+    """the tokens of a text, stored as arrays of character offsets
+
+    The text of the tokens is only sliced from the text when needed:
+    >>> tokens = TokenStore("Miguel de Cervantes")
+    >>> tokens.append(0, 6)
+    >>> tokens.append(7, 9)
+    >>> tokens[1]
+        'de'
+    >>> tokens.texts(0, 2)
+        ['Miguel', 'de']
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.starts = array("l")
+        self.ends = array("l")
+        # index of the first token of a sequence -> language of the sequence,
+        # when it differs from the language of the text (see NETagger._pack())
+        self.languages = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> str:
+        return self.text[self.starts[index] : self.ends[index]]
+
+    def append(self, start: int, end: int):
+        """add the token text[start:end]"""
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def extend(self, starts, ends):
+        """add the tokens text[starts[i]:ends[i]] (arrays of offsets)"""
+        import numpy as np
+
+        self.starts.frombytes(np.asarray(starts, dtype=self.starts.typecode).tobytes())
+        self.ends.frombytes(np.asarray(ends, dtype=self.ends.typecode).tobytes())
+
+    def texts(self, start=0, end=None) -> list:
+        """return the texts of the tokens[start:end]"""
+        text = self.text
+        return [
+            text[token_start:token_end]
+            for token_start, token_end in zip(
+                self.starts[start:end], self.ends[start:end]
+            )
+        ]
+
+
+class EntityDecoder:
+    """build the entities of a text from its BIO labelled tokens
+    (B-PERSON, I-PERSON, O, ...)
+
+    The tokens (TokenStore) and their label ids (see LABELS) are given in the
+    text order, by one or more calls to feed().
+    An entity is returned as soon as it cannot be extended anymore
+    (ie: when the next entity starts), the last entity is returned by close():
+    >>> decoder = EntityDecoder(text)
+    >>> entities = decoder.feed(tokens, labels)
+    >>> entities += decoder.feed(next_tokens, next_labels)
+    >>> entities += decoder.close()
+
+    The entities whose type is in LIST_ENT_TO_SKIP are ignored,
+    the GPE entities are labelled as LOC if GPE_to_LOC is True
+    and the whitespaces are stripped from the entities.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        # the last entity [type id, start, end], which can still be extended
+        # by an I- token (see label_tables())
+        self._entity = None
+        self._nb_tokens = 0
+
+    def feed(self, tokens, labels: array) -> list:
+        """add the labelled tokens and return the entities that are complete
+
+        The entity boundaries are computed on the arrays of label ids:
+        the tokens that are not entities (O and LIST_ENT_TO_SKIP types) are
+        ignored and an entity starts at each B- token, and at each I- token
+        whose type differs from the type of the previous entity token.
+        """
+        import numpy as np
+
+        assert len(tokens) == len(labels), f"{len(tokens)}\t{len(labels)}"
+        nb_tokens = self._nb_tokens
+        self._nb_tokens += len(tokens)
+        if not len(labels):
+            return []
+
+        kinds, types, type_names = label_tables()
+        label_ids = np.frombuffer(labels, dtype=np.uint16)
+        token_kinds = kinds[label_ids]
+        if (token_kinds == INCORRECT_LABEL).any():
+            label_id = label_ids[np.argmax(token_kinds == INCORRECT_LABEL)]
+            raise ValueError(f"Incorrect label :{LABELS[label_id]}")
+
+        # indexes of the tokens that are part of an entity
+        ent_tokens = np.flatnonzero(token_kinds != NOT_ENTITY)
+        if not len(ent_tokens):
+            return []
+        ent_kinds = token_kinds[ent_tokens]
+        ent_types = types[label_ids[ent_tokens]]
+        previous_types = np.empty_like(ent_types)
+        previous_types[0] = -1 if self._entity is None else self._entity[0]
+        previous_types[1:] = ent_types[:-1]
+        is_new = (ent_kinds == BEGIN) | (ent_types != previous_types)
 
-            assert len(ls_tokens) == len(
-                labels
-            ), f"{len(ls_tokens)}\t{len(labels)}, {ls_tokens}, {labels}"
-        # self.tokens = ls_tokens
-        # self.anno = labels
-        tokens = ls_tokens
+        # checking the list of tokens follows the BIO entities rules
+        for index in np.flatnonzero(is_new & (ent_kinds == INSIDE)):
+            self._log_incorrect_inside(
+                tokens,
+                ent_tokens[index],
+                nb_tokens,
+                LABELS[label_ids[ent_tokens[index]]],
+                (
+                    type_names[previous_types[index]]
+                    if previous_types[index] >= 0
+                    else None
+                ),
+            )
 
-        assert len(tokens) == len(
-            labels
-        ), f"{len(tokens)}\t{len(labels)}, {tokens}, {labels}"
+        # the (type, start, end) of the entities starting in these tokens
+        firsts = np.flatnonzero(is_new)
+        lasts = np.append(firsts[1:] - 1, len(ent_tokens) - 1)
+        starts = np.frombuffer(tokens.starts, dtype=tokens.starts.typecode)
+        ends = np.frombuffer(tokens.ends, dtype=tokens.ends.typecode)
+        new_entities = zip(
+            ent_types[firsts].tolist(),
+            starts[ent_tokens[firsts]].tolist(),
+            ends[ent_tokens[lasts]].tolist(),
+        )
 
-        # updating the entities
         entities = []
-        for i, (token, label) in enumerate(zip(tokens, labels)):
-            # skipping the entity if the entity is in LIST_ENT_TO_SKIP
-            if label.split("-")[-1] in LIST_ENT_TO_SKIP:
-                continue
-            token["label"] = label
-            if label == "O":
-                continue
-            if label.startswith("B-"):
-                entities.append(
-                    {
-                        "annotation": label.split("-")[1],
-                        "text": token["token"],
-                        "start": token["position"][0],
-                        "end": token["position"][1],
-                        "trailing_whitespace": token["trailing_whitespace"],
-                    }
-                )
-            elif label.startswith("I-"):
-                try:
-                    # checking the list of tokens follows the BIO entities rules
-                    assert label.split("-")[1] == entities[-1]["annotation"]
-                except AssertionError as e:
-                    # if a token is labelled as I-something and the previous token is
-                    # labelled as  B-somethingElse
-                    # it is extremely uncommun, but might occur on certain texts
-                    # eg: hugo.notredame.en.txt
-                    # it might happen between B-CARDINAL and I-MONEY
-                    logging.warning(f"{e}")
-                    logging.warning(
-                        f"new token has an entity label starting by I- label is:{label}'"
-                    )
-                    logging.warning(
-                        f"but previous token is labelled as: {entities[-1]['annotation']}'"
-                    )
-                    logging.warning(f"token number is {i}")
-                    logging.warning(f"current token is {token}")
-                    logging.warning(f"previous token is: {entities[-1]}")
-                    logging.warning("will update the token with current label")
-                    entities.append(
-                        {
-                            "annotation": label.split("-")[1],
-                            "text": token["token"],
-                            "start": token["position"][0],
-                            "end": token["position"][1],
-                            "trailing_whitespace": token["trailing_whitespace"],
-                        }
-                    )
-                else:
-                    entities[-1].update(
-                        {
-                            "end": token["position"][1],
-                            "trailing_whitespace": token["trailing_whitespace"],
-                            "text": entities[-1]["text"]
-                            + entities[-1]["trailing_whitespace"]
-                            + token["token"],
-                        }
-                    )
-            else:
-                raise ValueError(f"Incorrect label :{label}")
+        if not is_new[0]:
+            # the first tokens extend the last entity
+            last = lasts[0] if len(firsts) == 0 else firsts[0] - 1
+            self._entity[2] = int(ends[ent_tokens[last]])
+        for entity in new_entities:
+            if self._entity is not None:
+                entities.append(self._finalize(*self._entity))
+            self._entity = list(entity)
+        return entities
 
-        # merging the GPE to LOC:
-        if GPE_to_LOC:
-            for ent in entities:
-                if ent["annotation"] == "GPE":
-                    ent["annotation"] = "LOC"
+    def close(self) -> list:
+        """return the last entity (if any)"""
+        entities = [] if self._entity is None else [self._finalize(*self._entity)]
+        self._entity = None
+        return entities
 
-        # dropping trailing_whitespace key
-        for ent in entities:
-            del ent["trailing_whitespace"]
+    def _log_incorrect_inside(self, tokens, index, nb_tokens, label, previous_type):
+        """log an I- token whose type differs from the previous entity"""
+        # if a token is labelled as I-something and the previous token is
+        # labelled as  B-somethingElse
+        # it is extremely uncommun, but might occur on certain texts
+        # eg: hugo.notredame.en.txt
+        # it might happen between B-CARDINAL and I-MONEY
+        logging.warning(
+            f"new token has an entity label starting by I- label is:{label}'"
+        )
+        if previous_type is not None:
+            logging.warning(f"but previous token is labelled as: {previous_type}'")
+        else:
+            logging.warning("but there is no previous entity")
+        logging.warning(f"token number is {nb_tokens + index}")
+        logging.warning(
+            f"current token is '{tokens[index]}' ({tokens.starts[index]}, {tokens.ends[index]})"
+        )
+        logging.warning("will update the token with current label")
+
+    def _finalize(self, type_id: int, start: int, end: int) -> dict:
+        """return the entity as it is returned by NETagger.predict()
+
+        the whitespaces at the start and at the end of the entity are removed
+        """
+        annotation = label_tables()[2][type_id]
+        # merging the GPE to LOC:
+        if GPE_to_LOC and annotation == "GPE":
+            annotation = "LOC"
 
         # stripping the entities as some entities can start with spaces
-        for ent in entities:
-            # match at the start of the string
-            match = re.match(r"\s+", ent["text"])
-            if match:
+        text = self.text[start:end]
+        if text[:1].isspace() or text[-1:].isspace():
+            stripped = text.lstrip()
+            if len(stripped) != len(text):
                 logging.warning(
                     unidecode(
-                        f"entities (unidecoded) starts with whitespace ('{ent}' - {match}) -> updating it"
+                        f"entities (unidecoded) starts with whitespace ('{text}' - {start}) -> updating it"
                     )
                 )
-                # ent contains starting white space
                 # shifting the start to the right
-                ent["start"] += match.end()
-                ent["text"] = ent["text"][match.end() :]
-            # checking the end of the string
-            match = re.search(r"\s+$", ent["text"])
-            if match:
+                start += len(text) - len(stripped)
+            text = stripped.rstrip()
+            if len(text) != len(stripped):
                 logging.warning(
                     unidecode(
-                        f"entities (unidecoded) ends with whitespace ('{ent}' - {match}) -> updating it"
+                        f"entities (unidecoded) ends with whitespace ('{stripped}' - {end}) -> updating it"
                     )
                 )
                 # truncating the end
-                match_length = len(match[0])
-                ent["end"] -= match_length
-                ent["text"] = ent["text"][: match.start()]
-            assert (
-                self.text[ent["start"] : ent["end"]] == ent["text"]
-            ), f"error when updating an annotation starting or ending with spaces {ent}"
-        return entities
+                end -= len(stripped) - len(text)
+        return {"annotation": annotation, "text": text, "start": start, "end": end}
+
+
+# kinds of labels, see label_tables()
+NOT_ENTITY, BEGIN, INSIDE, INCORRECT_LABEL = 0, 1, 2, 3
+
+
+def label_tables():
+    """return the tables used to decode the label ids (see LABELS):
+        kinds: numpy array label id -> NOT_ENTITY, BEGIN, INSIDE or INCORRECT_LABEL
+        types: numpy array label id -> type id
+        type_names: list type id -> entity type (PERSON, GPE, ...)
+
+    the labels whose type is in LIST_ENT_TO_SKIP are NOT_ENTITY
+    """
+    import numpy as np
+
+    global _label_tables
+    key = (len(LABELS), tuple(LIST_ENT_TO_SKIP))
+    if _label_tables[0] != key:
+        kinds = np.full(len(LABELS), INCORRECT_LABEL, dtype=np.int8)
+        types = np.zeros(len(LABELS), dtype=np.int32)
+        # the labels are only appended to LABELS, so the type ids do not change
+        type_names = []
+        for label_id, label in enumerate(LABELS.labels[: key[0]]):
+            if label.startswith("B-") or label.startswith("I-"):
+                kinds[label_id] = BEGIN if label.startswith("B-") else INSIDE
+                if label[2:] not in type_names:
+                    type_names.append(label[2:])
+                types[label_id] = type_names.index(label[2:])
+            if label.split("-")[-1] in LIST_ENT_TO_SKIP or label == "O":
+                kinds[label_id] = NOT_ENTITY
+        _label_tables = (key, (kinds, types, type_names))
+    return _label_tables[1]
+
+
+# (key, tables) built by label_tables()
+_label_tables = (None, None)
+
+
+class SequencePacker:
+    """build the sequences of tokens the NER model is performed on
+
+    The length of the sequences is counted in BERT subwords, using the tokenizer
+    of the deepPavlov pipeline (see get_bert_preprocessor()), so that the
+    sequences do not exceed the max_seq_length of the model:
+        - the short sentences are packed together in a sequence
+        - the sentences that are too long are split, after a punctuation
+          token if possible
+
+    If the pipeline has no BERT preprocessor (ie: a custom model),
+    the length of the sequences is counted in tokens.
+    """
+
+    # subwords added to each sequence by the model ([CLS] and [SEP])
+    nb_special_subwords = 2
+
+    def __init__(self, ner_model=None):
+        preprocessor = get_bert_preprocessor(ner_model)
+        if preprocessor is None:
+            self.tokenizer = None
+            self.max_seq_length = None
+        else:
+            self.tokenizer = preprocessor.tokenizer
+            self.max_seq_length = preprocessor.max_seq_length
+            self.max_subword_length = getattr(preprocessor, "max_subword_length", None)
+        # token -> number of subwords
+        self._subword_lengths = {}
+
+    def token_length(self, token: str) -> int:
+        """return the number of subwords of the token in the model
+        (1 if the subwords cannot be counted)"""
+        if self.tokenizer is None:
+            return 1
+        try:
+            return self._subword_lengths[token]
+        except KeyError:
+            pass
+        nb_subwords = len(self.tokenizer.tokenize(token))
+        # the model replaces the tokens without subwords or with too many
+        # subwords by a single [UNK] subword
+        if not nb_subwords or (
+            self.max_subword_length and nb_subwords > self.max_subword_length
+        ):
+            nb_subwords = 1
+        if len(self._subword_lengths) > 1_000_000:
+            self._subword_lengths.clear()
+        self._subword_lengths[token] = nb_subwords
+        return nb_subwords
+
+    def max_length(self, length=250) -> int:
+        """return the maximum length of a sequence
+        (length tokens if the subwords cannot be counted)"""
+        if self.tokenizer is None:
+            return length
+        return self.max_seq_length - self.nb_special_subwords
+
+    def pack(
+        self,
+        tokens: list,
+        sentences: list,
+        length=250,
+        pack_sentences=True,
+        languages=None,
+    ):
+        """return the sequences of tokens to perform NER on
+
+        tokens is the TokenStore of the tokens of the text
+        sentences is the list of the (start, end) indexes in tokens of the sentences
+        length is the maximum number of tokens of a sequence when the subwords
+        cannot be counted
+        a sequence is a list of (start, end) indexes in tokens:
+        >>> packer.pack(tokens, [(0, 12), (13, 20), (21, 600)])
+            [[(0, 12), (13, 20)], [(21, 310)], [(310, 600)]]
+        if the languages of the sentences are given, the sentences of different
+        languages are not packed in the same sequence
+        """
+        max_length = self.max_length(length)
+        lengths = [self.token_length(token) for token in tokens.texts()]
+
+        sequences, sequence, sequence_length = [], [], 0
+        for i, (sent_start, sent_end) in enumerate(sentences):
+            new_language = languages and i > 0 and languages[i] != languages[i - 1]
+            for start, end in self._split(
+                tokens, lengths, sent_start, sent_end, max_length
+            ):
+                piece_length = sum(lengths[start:end])
+                if sequence and (
+                    not pack_sentences
+                    or new_language
+                    or sequence_length + piece_length > max_length
+                ):
+                    sequences.append(sequence)
+                    sequence, sequence_length = [], 0
+                sequence.append((start, end))
+                sequence_length += piece_length
+        if sequence:
+            sequences.append(sequence)
+        return sequences
+
+    def _split(self, tokens, lengths, start, end, max_length) -> list:
+        """split the sentence tokens[start:end] in pieces of at most max_length
+        and return their (start, end) indexes
+
+        the sentence is split after the last punctuation token of a piece,
+        unless this piece would be shorter than max_length / 2
+        """
+        pieces = []
+        piece_start, piece_length = start, 0
+        cut, cut_length = None, 0
+        i = start
+        while i < end:
+            if piece_length + lengths[i] > max_length and i > piece_start:
+                if cut is None or cut_length < max_length // 2:
+                    cut = i
+                pieces.append((piece_start, cut))
+                piece_start, piece_length = cut, 0
+                i, cut = cut, None
+                continue
+            piece_length += lengths[i]
+            i += 1
+            if is_safe_split(tokens[i - 1]):
+                cut, cut_length = i, piece_length
+        pieces.append((piece_start, end))
+        if len(pieces) > 1:
+            sentence = tokens.text[tokens.starts[start] : tokens.ends[end - 1]]
+            logging.warning(
+                f"SENTENCE TOO LONG ---"
+                + unidecode(sentence.replace("\n", "\\n"))[:100]
+                + f"... (CONVERTED TO ASCII) split in {len(pieces)} sequences"
+            )
+        return pieces
+
+
+# ner_model -> SequencePacker, see get_sequence_packer()
+_sequence_packers = weakref.WeakKeyDictionary()
+
+
+def get_sequence_packer(ner_model) -> SequencePacker:
+    """return the SequencePacker of the model (created on the first call)"""
+    try:
+        return _sequence_packers[ner_model]
+    except (KeyError, TypeError):
+        packer = SequencePacker(ner_model)
+    try:
+        _sequence_packers[ner_model] = packer
+    except TypeError:
+        # the model cannot be weakly referenced, the packer is not kept
+        pass
+    return packer
+
+
+def get_bert_preprocessor(ner_model):
+    """return the component of the deepPavlov pipeline that splits the tokens
+    into BERT subwords (it has a tokenizer and a max_seq_length),
+    None if the model has no such component"""
+    for component in getattr(ner_model, "pipe", []):
+        # the pipe of a deepPavlov Chainer contains tuples (in, out, component)
+        component = component[-1]
+        if hasattr(component, "tokenizer") and hasattr(component, "max_seq_length"):
+            return component
+    return None
+
+
+def is_safe_split(token: str) -> bool:
+    """return True if a sentence can be split after the token (punctuation)"""
+    return bool(token) and all(
+        unicodedata.category(char).startswith("P") or char.isspace() for char in token
+    )
+
+
+def set_intra_op_threads(nb_threads: int, inter_op_threads: int = None):
+    """set the number of threads a model uses to perform on a batch
+    (and the number of operations it runs at once if inter_op_threads is set)
+
+    the environment variables are read by the models loaded afterwards
+    (TensorFlow reads them when the model session is created), the number of
+    threads of torch is set at once if torch is imported
+    """
+    for variable in INTRA_OP_ENV_VARIABLES:
+        os.environ[variable] = str(nb_threads)
+    if inter_op_threads:
+        for variable in INTER_OP_ENV_VARIABLES:
+            os.environ[variable] = str(inter_op_threads)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(nb_threads)
+    logging.info(f"intra-op threads set to {nb_threads}")
+
+
+def check_token_offsets(tokens):
+    """assert the tokens (TokenStore) are in the text order, do not overlap
+    and are inside the text (checked on the arrays of offsets at once)"""
+    import numpy as np
+
+    if not len(tokens):
+        return
+    starts = np.frombuffer(tokens.starts, dtype=tokens.starts.typecode)
+    ends = np.frombuffer(tokens.ends, dtype=tokens.ends.typecode)
+    assert starts[0] >= 0 and ends[-1] <= len(tokens.text), "token outside the text"
+    assert np.all(starts <= ends), "token ending before its start"
+    assert np.all(starts[1:] >= ends[:-1]), "overlapping tokens"
+
+
+def get_nlp_small():
+    """return the spacy pipeline used for tokenization (SPACY_MODEL),
+    load it on the first call"""
+    global _nlp_small
+    with _nlp_small_lock:
+        if _nlp_small is None:
+            import spacy
+
+            logging.info(f"loading the spacy model '{SPACY_MODEL}'")
+            nlp_small = spacy.load(SPACY_MODEL, disable=["ner", "parser", "tagger"])
+            # setting the maximum number of tokens the pipeline can support
+            # (safe if ner, parser and tagger are disabled)
+            nlp_small.max_length = 1_000_000_000
+            _nlp_small = nlp_small
+    return _nlp_small
+
+
+def detect_language(text: str, cache=True) -> str:
+    """return the ISO-639-1 code of the language of the text
+    (detected on a sample of the text, see nlp_utils.detect_language())"""
+    import nlp_utils
+
+    return nlp_utils.detect_language(text, cache=cache)
+
+
+def check_text(text: str):
+    """assert the text can be tagged"""
+    assert isinstance(text, str), f"text type should be a string, not a {type(text)}"
+    assert len(text), "text is empty"
+    if len(text) > 100000:
+        logging.warning(
+            f"text is long ({len(text)} characters), performing NER on it could cause warnings"
+        )
+
+
+def shift_offsets(offsets: array, shift: int) -> array:
+    """return a copy of the array of offsets with shift added to each offset"""
+    import numpy as np
+
+    if not shift or not len(offsets):
+        return offsets[:]
+    shifted = array(offsets.typecode)
+    shifted.frombytes(
+        (np.frombuffer(offsets, dtype=offsets.typecode) + shift).tobytes()
+    )
+    return shifted
+
+
+def shift_sequences(sequences: list, shift: int) -> list:
+    """return the sequences (see SequencePacker.pack()) with shift added
+    to their token indexes"""
+    if not shift:
+        return list(sequences)
+    return [
+        [(start + shift, end + shift) for start, end in ranges] for ranges in sequences
+    ]
 
 
 def chunks(lst, n):
@@ -1,13 +1,17 @@
 #!/bin/python3.6
+import hashlib
 import logging
+import multiprocessing
 import os
 import re
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 import nltk
 import treetaggerwrapper
 from treetaggerwrapper import TreeTaggerError
-from langdetect import detect
+from langdetect.detector_factory import PROFILES_DIRECTORY, DetectorFactory
 from nltk.tokenize.punkt import PunktSentenceTokenizer
 
 
@@ -76,18 +80,214 @@ def load_sent_tokenizer(language: str):
     return sent_tokenizer
 
 
+# loaded sentence tokenizers: language -> sent_tokenizer
+SENT_TOKENIZERS = {}
+_sent_tokenizers_lock = threading.Lock()
+
+
+def get_sent_tokenizer(language: str):
+    """return the nltk sent_tokenizer object associated with language
+
+    the tokenizer is loaded with load_sent_tokenizer() on the first call
+    only, the next calls return the same object
+    """
+    try:
+        return SENT_TOKENIZERS[language]
+    except KeyError:
+        with _sent_tokenizers_lock:
+            if language not in SENT_TOKENIZERS:
+                SENT_TOKENIZERS[language] = load_sent_tokenizer(language)
+        return SENT_TOKENIZERS[language]
+
+
+def warm_up_sent_tokenizers(languages=None):
+    """load the sentence tokenizers of the languages (ISO-639-1 codes)
+    so that tokenize_into_sentences() does not load them from disk
+    >>> warm_up_sent_tokenizers(["en", "fr", "de"])
+
+    all the languages of dict_iso_to_full_language_name are loaded by default
+    """
+    if languages is None:
+        languages = dict_iso_to_full_language_name
+    for language in languages:
+        get_sent_tokenizer(language)
+    logging.info(f"sentence tokenizers loaded for: {sorted(SENT_TOKENIZERS)}")
+
+
 def tokenize_into_sentences(text, language) -> list:
     """return a list of tupples
     matching the sentences in the text,
     according to the language parameter
     """
-    logging.debug(f"loading sentence tokenizer")
-    tokenizer = load_sent_tokenizer(language)
-    logging.debug(f"done loading sentence tokenizer")
+    tokenizer = get_sent_tokenizer(language)
     logging.info(f"tokenizing text into sentences")
     return [sent for sent in tokenizer.span_tokenize(text)]
 
 
+# the language is detected on LANGDETECT_NB_PIECES pieces of text evenly spaced
+# in the text, making about LANGDETECT_SAMPLE_SIZE characters
+LANGDETECT_SAMPLE_SIZE = 5000
+LANGDETECT_NB_PIECES = 5
+# seed of the random generator of langdetect, the results are reproducible
+LANGDETECT_SEED = 0
+# number of texts whose language is cached by detect_language()
+DETECTED_LANGUAGES_CACHE_SIZE = 10_000
+# (hash of the text, sample_size, nb_pieces, seed) -> language
+_detected_languages = OrderedDict()
+_detected_languages_lock = threading.Lock()
+# langdetect DetectorFactory, its profiles are loaded on the first detection
+_detector_factory = None
+_detector_factory_lock = threading.Lock()
+
+
+def sample_text(
+    text: str, sample_size=LANGDETECT_SAMPLE_SIZE, nb_pieces=LANGDETECT_NB_PIECES
+) -> str:
+    """return nb_pieces pieces of the text evenly spaced in the text, making about
+    sample_size characters (the whole text if it is shorter)
+    the pieces are not cut in the middle of words
+    """
+    if len(text) <= sample_size:
+        return text
+    piece_size = sample_size // nb_pieces
+    step = (len(text) - piece_size) / max(nb_pieces - 1, 1)
+    pieces = []
+    for i in range(nb_pieces):
+        start = int(i * step)
+        piece = text[start : start + piece_size]
+        if start:
+            # removing the first word (cut)
+            piece = re.split(r"\s", piece, maxsplit=1)[-1]
+        if start + piece_size < len(text):
+            # removing the last word (cut)
+            piece = re.split(r"\s(?=\S*$)", piece, maxsplit=1)[0]
+        pieces.append(piece)
+    return "\n".join(pieces)
+
+
+def detect_language(
+    text: str,
+    sample_size=LANGDETECT_SAMPLE_SIZE,
+    nb_pieces=LANGDETECT_NB_PIECES,
+    seed=LANGDETECT_SEED,
+    cache=True,
+) -> str:
+    """return the ISO-639-1 code of the language of the text
+    >>> detect_language("Elles mangent des pommes.")
+        'fr'
+
+    langdetect is only run on a sample of the text (see sample_text()), with a
+    fixed seed, the language of the last texts is cached (unless cache is False,
+    eg: for the sentences of a text). Several threads can detect languages at once.
+    """
+    if not cache:
+        return _detect(sample_text(text, sample_size, nb_pieces), seed)
+    key = (
+        hashlib.sha1(text.encode("UTF-8", "surrogatepass")).hexdigest(),
+        sample_size,
+        nb_pieces,
+        seed,
+    )
+    with _detected_languages_lock:
+        if key in _detected_languages:
+            _detected_languages.move_to_end(key)
+            return _detected_languages[key]
+    language = _detect(sample_text(text, sample_size, nb_pieces), seed)
+    with _detected_languages_lock:
+        _detected_languages[key] = language
+        if len(_detected_languages) > DETECTED_LANGUAGES_CACHE_SIZE:
+            _detected_languages.popitem(last=False)
+    return language
+
+
+def _detect(text: str, seed: int) -> str:
+    """return the language of the text detected by langdetect
+
+    each langdetect Detector has its own random generator seeded with seed,
+    only its creation is locked
+    """
+    global _detector_factory
+    with _detector_factory_lock:
+        if _detector_factory is None:
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            _detector_factory = factory
+        _detector_factory.set_seed(seed)
+        detector = _detector_factory.create()
+    detector.append(text)
+    return detector.detect().split("-")[0]
+
+
+# spaces after the last token
+SPACES_RE = re.compile(r"\s*")
+# by default TT changes '…' to '...'
+ELLIPSIS_RE = re.compile(r"\s*…")
+
+
+def align_tokens(text: str, tags: list) -> list:
+    """return the tokens of the TreeTagger tags (see treetaggerwrapper.make_tags())
+    with their positions in the text:
+    [{'word': 'Elles', 'pos': 'PRO:PER', 'lemma': 'elle', 'start': 0, 'end': 5}, ...]
+
+    The tokens are searched from the end of the previous one with the positions
+    arguments of the patterns and of str.find(), the rest of the text is never
+    copied so the alignment is linear in the length of the text.
+    """
+    tokens = []
+    last_pos = 0
+    for tag in tags:
+        word = tag[0]
+        if word == "..." and ELLIPSIS_RE.match(text, last_pos):
+            # the token has been replaced from '…' to '...'
+            # (note that the token can also be '...')
+            logging.debug("remplacing ... by …")
+            word = "…"
+        # the token is searched after the spaces following the last token
+        # only, otherwise the search could go very far in the text
+        spaces_end = SPACES_RE.match(text, last_pos).end()
+        token_position = text.find(word, last_pos, spaces_end + len(word))
+        if token_position == -1:
+            logging.warning(
+                f"cannot find 1st substring (word is: '{word}'). Checking another position ..."
+            )
+            # checking if the token is an Acronym as
+            # Acronyms like U.S.A. are systematically written
+            # with a final dot, even if it is missing in original file. See
+            # https://treetaggerwrapper.readthedocs.io/en/latest/#other-things-done-by-this-module
+            word = word.strip(".")
+            token_position = text.find(word, last_pos)
+            if token_position == -1:
+                logging.critical(f"cannot find {tag} even without trailing dot")
+                raise ValueError(f"cannot find {tag} after position {last_pos}")
+            logging.warning(f"-> found corresponding substring")
+        if token_position - last_pos > 100:
+            logging.warning(
+                f"token position is too far. Last pos is {last_pos} new pos is {token_position}"
+            )
+        if type(tag) == treetaggerwrapper.Tag:
+            pos = tag[1]
+            lemma = tag[2]
+        elif type(tag) == treetaggerwrapper.NotTag:
+            pos = ""
+            lemma = word
+        last_pos = token_position + len(word)
+        tokens.append(
+            {
+                "word": word,
+                "pos": pos,
+                "lemma": lemma,
+                "start": token_position,
+                "end": last_pos,
+            }
+        )
+    # last assertion
+    for token in tokens:
+        assert (
+            token["word"] == text[token["start"] : token["end"]]
+        ), "the token position doesnt match in the text"
+    return tokens
+
+
 class TreeTaggerImproved(treetaggerwrapper.TreeTagger):
     """same class as TreeTagger objects,
     but witht a tag_text_tokens() method that give the token positions
@@ -119,7 +319,7 @@ class TreeTaggerImproved(treetaggerwrapper.TreeTagger):
         the default self.lang is English
         This method assert the self.lang is the same language
         as the text passed in argument"""
-        detected_language = detect(text)
+        detected_language = detect_language(text)
         if detected_language != self.lang:
             msg = f"detected language of text is  '{detected_language}', but self.lang is '{self.lang}'. Did you instanciate the tagger with TAGLANG parameter? >>> nlp_utils.TreeTaggerImproved(TAGLANG='fr')"
             if strict:
@@ -141,86 +341,7 @@ class TreeTaggerImproved(treetaggerwrapper.TreeTagger):
             notagdns=True,
             nosgmlsplit=True,
         )
-        ls_tags = treetaggerwrapper.make_tags(tags)
-        ls_tokens = []
-        last_pos = 0
-        num_errors = 0
-        for i, tag in enumerate(ls_tags):
-            # print(i, tag, f"last_pos: {last_pos}")
-            word = tag[0]
-            if word == "...":
-                # by default TT changes '…' to '...'
-                # this causes misleading characters count
-                # note that the token can also be '...'
-                # we check that the token has not been replaced:
-                if re.match(r"\s*…", text[last_pos:]):
-                    # the token has been replaced from '…' to '...'
-                    logging.debug("remplacing ... by …")
-                    word = "…"
-            # counting the number of spaces after last token
-            num_spaces_after_last_token = re.match("\s*", text[last_pos:]).span()[1]
-            try:
-                # the new token position is the sum of the last position,
-                # and the index of the text containing the word.
-                # upper limit in the search method in the text
-                # with num_spaces_after_last_token, otherwise,
-                # the index search could go very far in the text
-                token_position = last_pos + text[
-                    last_pos : last_pos + num_spaces_after_last_token + len(word)
-                ].index(word)
-            except Exception as e:
-                logging.warning(
-                    f"cannot find 1st substring (word is: '{word}'). Checking another position ..."
-                )
-                # checking if the token is an Acronym as
-                # Acronyms like U.S.A. are systematically written
-                # with a final dot, even if it is missing in original file. See
-                # https://treetaggerwrapper.readthedocs.io/en/latest/#other-things-done-by-this-module
-                token_position = None
-                try:
-                    token_position = last_pos + text[last_pos:].index(word.strip("."))
-                    word = word.strip(".")
-                except Exception as e2:
-                    logging.critical(f"cannot find {tag} even without trailing dot")
-                    raise e2
-                if token_position is None:
-                    # the token position could be equal to 0
-                    # so checking for the booleaness can raise Error
-                    logging.critical(f"ignoring {tag}")
-                    logging.critical(f"\ttoken position: {token_position}")
-                    logging.critical(f"\tlast_position {last_pos}")
-                    logging.critical(f"\t{e}")
-                    num_errors += 1
-                    # continue
-                    raise e
-                logging.warning(f"-> found corresponding substring")
-            if token_position - last_pos > 100:
-                logging.warning(
-                    f"token position is too far. Last pos is {last_pos} new pos is {token_position}"
-                )
-            if type(tag) == treetaggerwrapper.Tag:
-                pos = tag[1]
-                lemma = tag[2]
-            elif type(tag) == treetaggerwrapper.NotTag:
-                pos = ""
-                lemma = word
-            token = {
-                "word": word,
-                "pos": pos,
-                "lemma": lemma,
-                "start": token_position,
-                "end": token_position + len(word),
-            }
-            ls_tokens.append(token)
-            last_pos = token["end"]
-        if num_errors:
-            logging.error(f"{num_errors} on {i} tokens")
-        # last assertion
-        for token in ls_tokens:
-            assert (
-                token["word"] == text[token["start"] : token["end"]]
-            ), "the token position doesnt match in the text"
-        return ls_tokens
+        return align_tokens(text, treetaggerwrapper.make_tags(tags))
 
     def get_text_lemmatized(self, text, check_language=True):
         "return a lemmatized version of the text"
@@ -230,5 +351,133 @@ class TreeTaggerImproved(treetaggerwrapper.TreeTagger):
         return " ".join([word["lemma"] for word in tokens])
 
 
+# the long texts are cut in segments of about TREETAGGER_SEGMENT_SIZE characters
+# tagged in parallel by TreeTaggerPool
+TREETAGGER_SEGMENT_SIZE = 100_000
+# language -> TreeTaggerImproved of a worker process of a TreeTaggerPool
+_pool_taggers = {}
+_pool_tagger_kwargs = {}
+
+
+def split_text(text: str, segment_size=TREETAGGER_SEGMENT_SIZE) -> list:
+    """return the [(offset, segment), ...] of the text cut in segments of at most
+    segment_size characters, on a new line (or else on a space) so that the
+    tokens are not cut"""
+    segments = []
+    start = 0
+    while len(text) - start > segment_size:
+        end = text.rfind("\n", start + segment_size // 2, start + segment_size)
+        if end == -1:
+            end = text.rfind(" ", start + segment_size // 2, start + segment_size)
+        if end == -1:
+            end = start + segment_size
+        segments.append((start, text[start:end]))
+        start = end
+    segments.append((start, text[start:]))
+    return segments
+
+
+def _init_pool_worker(tagger_kwargs: dict):
+    _pool_tagger_kwargs.update(tagger_kwargs)
+
+
+def _tag_segment(task: tuple) -> list:
+    """return the tokens of a segment (language, offset, segment) of a text,
+    with their positions in the text"""
+    language, offset, segment = task
+    tagger = _pool_taggers.get(language)
+    if tagger is None:
+        logging.info(f"starting TreeTagger '{language}' in process {os.getpid()}")
+        tagger = TreeTaggerImproved(TAGLANG=language, **_pool_tagger_kwargs)
+        _pool_taggers[language] = tagger
+    tokens = tagger.tag_text_tokens(segment, check_language=False)
+    for token in tokens:
+        token["start"] += offset
+        token["end"] += offset
+    return tokens
+
+
+class TreeTaggerPool:
+    """tag texts in parallel with worker processes, each keeping one
+    TreeTaggerImproved (one TreeTagger process) per language alive
+    >>> with nlp_utils.TreeTaggerPool(processes=4) as pool:
+    ...     ls_tokens = list(pool.tag_texts_tokens(texts, language="fr"))
+    ...     lemmatized_text = pool.get_text_lemmatized(long_text, language="fr")
+
+    The texts are cut in segments of at most segment_size characters (see
+    split_text()), the segments are tagged by the workers and the tokens are
+    put back in the order of the texts, with their positions in the texts.
+    The language is detected on each text if not given.
+    tagger_kwargs are given to TreeTaggerImproved (TAGDIR, TAGOPT, ...), but
+    TAGLANG: the workers start one TreeTagger per language of the texts.
+    """
+
+    def __init__(
+        self, processes=None, segment_size=TREETAGGER_SEGMENT_SIZE, **tagger_kwargs
+    ):
+        if "TAGLANG" in tagger_kwargs:
+            raise ValueError(
+                "TAGLANG cannot be given to TreeTaggerPool,"
+                " give the language to tag_texts_tokens() instead"
+            )
+        self.processes = processes or os.cpu_count()
+        self.segment_size = segment_size
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(
+            self.processes, initializer=_init_pool_worker, initargs=(tagger_kwargs,)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """stop the worker processes and their TreeTagger processes"""
+        self._pool.terminate()
+        self._pool.join()
+
+    def tag_texts_tokens(self, texts, language: str = None):
+        """yield the tokens of each text (see TreeTaggerImproved.tag_text_tokens()),
+        in the order of the texts"""
+        ls_segments = []
+
+        def tasks():
+            for text in texts:
+                text_language = language or detect_language(text)
+                segments = split_text(text, self.segment_size)
+                ls_segments.append(len(segments))
+                for offset, segment in segments:
+                    yield text_language, offset, segment
+
+        results = self._pool.imap(_tag_segment, tasks())
+        nb_texts = 0
+        while True:
+            try:
+                tokens = next(results)
+            except StopIteration:
+                break
+            # the number of segments of the text is known once its first
+            # segment is sent
+            for _ in range(ls_segments[nb_texts] - 1):
+                tokens.extend(next(results))
+            nb_texts += 1
+            yield tokens
+
+    def tag_text_tokens(self, text: str, language: str = None) -> list:
+        """return the tokens of the text, its segments are tagged in parallel"""
+        return next(self.tag_texts_tokens([text], language))
+
+    def get_texts_lemmatized(self, texts, language: str = None):
+        """yield a lemmatized version of each text"""
+        for tokens in self.tag_texts_tokens(texts, language):
+            yield " ".join([word["lemma"] for word in tokens])
+
+    def get_text_lemmatized(self, text: str, language: str = None) -> str:
+        "return a lemmatized version of the text"
+        return next(self.get_texts_lemmatized([text], language))
+
+
 if __name__ == "__main__":
     pass
@@ -1,17 +1,29 @@
 """
 """
+import bz2
 import csv
+import gzip
 import inspect
+import io
 import json
 import html
 import logging
+import lzma
+import mmap
 import os
+import shutil
+import struct
 import sys
+import tempfile
+from array import array
 from datetime import datetime
 
+import numpy as np
 from tqdm import tqdm
 from yattag import Doc
 
+from text_utils.text_utils import common_prefix_length
+
 __location__ = os.path.join(
     os.getcwd(), os.path.dirname(inspect.getfile(inspect.currentframe()))
 )
@@ -73,6 +85,8 @@ class Serializer:
             self.to_json(out_file)
         elif format_ == "html":
             self.to_html(out_file)
+        elif format_ == "columnar":
+            self.to_columnar(out_file)
         else:
             self.to_linked_data(out_file, format_)
 
@@ -97,6 +111,14 @@ class Serializer:
             json.dump(self.data, f, indent=4)
         logging.info(f"outfile:\t{out_file}")
 
+    def to_columnar(self, out_file: str, doc_id=0):
+        """export the annotations to a columnar file (see ColumnarSink),
+        read it with ColumnarReader"""
+        logging.info(f"exporting the annotations to a columnar file {out_file}")
+        with ColumnarSink(out_file) as sink:
+            sink.write(doc_id, self.data)
+        logging.info(f"outfile:\t{out_file}")
+
     def to_temporary_json(self, out_file: str):
         """export the annotations to a specific json format that contains:
 
@@ -114,6 +136,7 @@ class Serializer:
         temporary_data = []
         nb_char_suffix = 100  # for performance reason 100
         # suffix length is the best compromise
+        index = PrefixIndex(self.text)
 
         for anno in tqdm(self.data):
 
@@ -124,24 +147,11 @@ class Serializer:
             # however, in order to desambiguate,
             # if the prefix is present more than one time in the
             # document, it will create a longer prefix
-
-            for i in range(nb_char_suffix, anno["start"], 50):
-                # print(i)
-                prefix_start = anno["start"] - i
-                prefix_string = self.text[prefix_start : anno["start"]]
-                # if self.text.count(prefix_string) > 1:
-                if occurrences(self.text, prefix_string) > 1:
-                    # print("OCCURENCE")
-                    # using occurences as count does not return overlaping
-                    # strings
-                    continue
-                break
-            else:
-                prefix_start = 0
-                prefix_string = self.text[: anno["start"]]
+            # (of nb_char_suffix, nb_char_suffix + 50, ... characters)
+            prefix_start = index.unique_prefix_start(anno["start"], nb_char_suffix, 50)
+            prefix_string = self.text[prefix_start : anno["start"]]
 
             assert prefix_start + len(prefix_string) == anno["start"]
-            assert prefix_start == self.text.index(prefix_string)
 
             suffix = self.text[
                 anno["end"] : min(len(self.text), anno["end"] + nb_char_suffix)
@@ -168,12 +178,15 @@ class Serializer:
     def to_html(self, out_file: str):
         """export the annotation in a html page
 
-        if annotations are overlapping,
-        it will skip the last annotation
-
+        The page is written while going through the text and the annotations
+        (sorted by start) once, the html text is never built in memory.
+        If annotations are overlapping, the annotation starting first is kept
+        (the first one of self.data if they start at the same character)
+        and the annotations starting before its end are skipped.
         """
         logging.info(f"exporting the annotations to html: '{out_file}'")
 
+        # the html page around the text
         doc, tag, text = Doc().tagtext()
         doc.asis("<!DOCTYPE html>")
         with tag("html"):
@@ -181,7 +194,6 @@ class Serializer:
                 doc.stag("meta", charset="UTF-8")
                 with tag("style", ("type", "text/css")):
                     doc.asis(get_style_sheet())
-            logging.info("creating the HTML...")
             with tag("body"):
                 with tag("h3"):
                     text(f"{datetime.now()}"[:16])
@@ -194,41 +206,7 @@ class Serializer:
                     with tag("tr"):
                         with tag("td", ("width", "70%")):
                             with tag("div", ("class", "td_text")):
-                                html_text = self.text
-                                # escaping html characters
-                                # as a regular html.escape() demands more work
-                                # on the string length
-                                html_text = html_text.replace(
-                                    "<", "ᐸ"
-                                )  # 1438	 CANADIAN SYLLABICS PA
-                                html_text = html_text.replace(
-                                    ">", "ᐳ"
-                                )  # 1433	 CANADIAN SYLLABICS PO
-                                html_text = html_text.replace("&", "﹠")
-                                # new_text=re.sub('"', "''", new_text)
-                                ls_ent_type = []
-                                for ent in sorted(
-                                    self.data, key=lambda k: k["start"], reverse=True
-                                ):
-                                    ls_ent_type.append(ent["annotation"])
-                                    if "title" not in ent:
-                                        ent["title"] = ent["annotation"]
-
-                                    html_text = (
-                                        html_text[: ent["start"]]
-                                        + '<span class="'
-                                        + ent["annotation"].lower()
-                                        + '" title="'
-                                        + html.escape(ent["title"])
-                                        + " &#10;"
-                                        + ent.get("reason", "")
-                                        + '">'
-                                        + ent["text"]
-                                        + "</span>"
-                                        + html_text[ent["end"] :]
-                                    )
-                                html_text = html_text.replace("\n", "<br>\n")
-                                doc.asis(html_text)
+                                doc.asis(HTML_TEXT_PLACEHOLDER)
                         with tag("td", ("width", "30%"), ("class", "legend")):
                             for type_ in sorted(
                                 set([ann["annotation"] for ann in self.data])
@@ -236,12 +214,516 @@ class Serializer:
                                 with tag("span", ("class", type_.lower())):
                                     text(type_)
                                     doc.asis("<br>")
+        page_start, page_end = doc.getvalue().split(HTML_TEXT_PLACEHOLDER)
 
+        logging.info("creating the HTML...")
         with open(out_file, "w", encoding="UTF-8") as file:
-            print(doc.getvalue(), file=file)
+            file.write(page_start)
+            last_end = 0
+            for ent in self.data:
+                if ent["start"] < last_end:
+                    logging.warning(
+                        f"skipping the annotation {ent} overlapping the previous one"
+                    )
+                    continue
+                if "title" not in ent:
+                    ent["title"] = ent["annotation"]
+                write_html_text(file, self.text, last_end, ent["start"])
+                file.write(
+                    (
+                        '<span class="'
+                        + ent["annotation"].lower()
+                        + '" title="'
+                        + html.escape(ent["title"])
+                        + " &#10;"
+                        + ent.get("reason", "")
+                        + '">'
+                    ).replace("\n", "<br>\n")
+                )
+                write_html_text(file, ent["text"], 0, len(ent["text"]))
+                file.write("</span>")
+                last_end = ent["end"]
+            write_html_text(file, self.text, last_end, len(self.text))
+            print(page_end, file=file)
         logging.info(f"outfile:\t{out_file}")
 
 
+# marks the place of the text in the html page, see Serializer.to_html()
+HTML_TEXT_PLACEHOLDER = "\x00HTML_TEXT\x00"
+# the text is written to the html page by pieces of HTML_PIECE_SIZE characters
+HTML_PIECE_SIZE = 2**16
+# escaping html characters
+# as a regular html.escape() demands more work
+# on the string length
+HTML_ESCAPE_TABLE = str.maketrans(
+    {
+        "<": "ᐸ",  # 1438	 CANADIAN SYLLABICS PA
+        ">": "ᐳ",  # 1433	 CANADIAN SYLLABICS PO
+        "&": "﹠",
+        "\n": "<br>\n",
+    }
+)
+
+
+def write_html_text(file, text: str, start: int, end: int):
+    """write text[start:end] to the html file, by pieces of HTML_PIECE_SIZE
+    characters"""
+    for piece_start in range(start, end, HTML_PIECE_SIZE):
+        piece = text[piece_start : min(piece_start + HTML_PIECE_SIZE, end)]
+        file.write(piece.translate(HTML_ESCAPE_TABLE))
+
+
+class DocumentSink:
+    """write the entities of a stream of documents to a file, as the documents
+    are tagged (see JsonlSink and TsvSink)
+    >>> with JsonlSink("entities.jsonl.gz") as sink:
+    ...     sink.write_documents(zip(ids, ner_model.predict_many(texts)))
+
+    The lines are buffered and written by blocks of about buffer_size characters,
+    the memory used does not depend on the number of documents.
+    The file is compressed if compression is "gzip", "bz2" or "lzma", the
+    compression is guessed from the extension of the file by default
+    (.gz, .bz2, .xz). If append is True, the lines are added at the end of
+    the file.
+    """
+
+    def __init__(
+        self, out_file: str, compression=None, append=False, buffer_size=2**20
+    ):
+        self.out_file = out_file
+        if compression is None:
+            compression = COMPRESSIONS.get(os.path.splitext(out_file)[1])
+        if compression not in OPENERS:
+            raise ValueError(
+                f"unknown compression '{compression}', use one of {sorted(OPENERS, key=str)}"
+            )
+        self.compression = compression
+        self.append = append
+        self.buffer_size = buffer_size
+        self.nb_documents = 0
+        self.nb_entities = 0
+        # the file is new or empty
+        self._new_file = not (append and os.path.exists(out_file)) or (
+            os.path.getsize(out_file) == 0
+        )
+        self._file = OPENERS[compression](
+            out_file, "at" if append else "wt", encoding="UTF-8"
+        )
+        self._buffer = io.StringIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, doc_id, entities: list, **fields):
+        """add the entities of the document doc_id
+        (the fields are added to the line of the document, for JsonlSink only)"""
+        self._write_document(doc_id, entities, fields)
+        self.nb_documents += 1
+        self.nb_entities += len(entities)
+        if self._buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def write_documents(self, documents) -> int:
+        """add the documents [(doc_id, entities), ...] and return their number"""
+        nb_documents = self.nb_documents
+        for doc_id, entities in documents:
+            self.write(doc_id, entities)
+        return self.nb_documents - nb_documents
+
+    def flush(self):
+        """write the buffered lines to the file"""
+        self._file.write(self._buffer.getvalue())
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def close(self):
+        """write the buffered lines and close the file"""
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        logging.info(
+            f"{self.nb_documents} documents ({self.nb_entities} entities) written to {self.out_file}"
+        )
+
+    def _write_document(self, doc_id, entities: list, fields: dict):
+        raise NotImplementedError
+
+
+class JsonlSink(DocumentSink):
+    """write one compact json line per document:
+    {"id":"doc1.txt","entities":[{"annotation":"PERSON","text":"Obama",...},...]}
+    """
+
+    def _write_document(self, doc_id, entities: list, fields: dict):
+        record = {"id": doc_id, "entities": entities}
+        record.update(fields)
+        self._buffer.write(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        )
+
+
+class TsvSink(DocumentSink):
+    """write one tsv line per entity: id, text, annotation, start, end
+    (the header is written at the start of a new file)"""
+
+    fieldnames = ["id", "text", "annotation", "start", "end"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writer = csv.writer(self._buffer, delimiter="\t", lineterminator="\n")
+        if self._new_file:
+            self._writer.writerow(self.fieldnames)
+
+    def _write_document(self, doc_id, entities: list, fields: dict):
+        self._writer.writerows(
+            [doc_id, ent["text"], ent["annotation"], ent["start"], ent["end"]]
+            for ent in entities
+        )
+
+
+# file extension -> compression of the DocumentSink
+COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma"}
+# compression -> function opening the file
+OPENERS = {None: open, "gzip": gzip.open, "bz2": bz2.open, "lzma": lzma.open}
+
+
+def open_sink(out_file: str, **kwargs) -> DocumentSink:
+    """return the DocumentSink matching the extension of out_file
+    (TsvSink for .tsv files, ColumnarSink for .nerc files, JsonlSink otherwise),
+    eg: entities.tsv.gz"""
+    name = out_file
+    if os.path.splitext(name)[1] in COMPRESSIONS:
+        name = os.path.splitext(name)[0]
+    if os.path.splitext(name)[1] == COLUMNAR_EXTENSION:
+        if name != out_file:
+            raise ValueError("the columnar files are memory-mapped, not compressed")
+        return ColumnarSink(out_file, **kwargs)
+    if os.path.splitext(name)[1] == ".tsv":
+        return TsvSink(out_file, **kwargs)
+    return JsonlSink(out_file, **kwargs)
+
+
+# columnar entity files, see ColumnarSink and ColumnarReader
+COLUMNAR_EXTENSION = ".nerc"
+COLUMNAR_MAGIC = b"NERCOL01"
+# name, typecode of the array while writing, little endian dtype in the file
+COLUMNAR_COLUMNS = [
+    ("doc", "I", "<u4"),  # index of the document of each entity
+    ("start", "q", "<i8"),
+    ("end", "q", "<i8"),
+    ("label", "H", "<u2"),  # index of the annotation in the labels of the header
+    ("text_offsets", "Q", "<u8"),  # entity i: text_heap[offsets[i]:offsets[i + 1]]
+    ("text_heap", "B", "u1"),  # utf-8 texts of the entities
+    ("doc_offsets", "Q", "<u8"),  # document d: entities doc_offsets[d]:[d + 1]
+    ("doc_id_offsets", "Q", "<u8"),
+    ("doc_id_heap", "B", "u1"),  # utf-8 ids of the documents
+    ("doc_id_order", "I", "<u4"),  # document indices sorted by the bytes of the ids
+]
+
+
+class ColumnarSink(DocumentSink):
+    """write the entities of a stream of documents to a columnar file
+    that ColumnarReader reads by memory-mapping it
+    >>> with ColumnarSink("entities.nerc") as sink:
+    ...     sink.write_documents(zip(ids, ner_model.predict_many(texts)))
+
+    The file is made of a json header (labels, number of entities and documents,
+    position of the columns) followed by the columns: the document index, start,
+    end and label id of the entities as fixed-width little endian arrays,
+    and the texts of the entities and the ids of the documents (as strings)
+    in two utf-8 heaps indexed by offset arrays, and the document indices
+    sorted by id to search the documents by id.
+    The columns are buffered in memory and spilled to temporary files every
+    buffer_size bytes, they are written to out_file when the sink is closed.
+    The extra fields of write() are ignored.
+    The file cannot be compressed nor appended to (compression and append
+    are only accepted to be used like the other sinks, see open_sink()).
+    """
+
+    def __init__(
+        self, out_file: str, compression=None, append=False, buffer_size=2**20
+    ):
+        if compression is not None:
+            raise ValueError("the columnar files are memory-mapped, not compressed")
+        if append:
+            raise ValueError(
+                "the columnar files cannot be appended to, their header is"
+                " written when the sink is closed"
+            )
+        self.out_file = out_file
+        self.buffer_size = buffer_size
+        self.nb_documents = 0
+        self.nb_entities = 0
+        # label -> label id
+        self.labels = {}
+        self._file = open(out_file, "wb")
+        self._columns = {
+            name: array(typecode) for name, typecode, _ in COLUMNAR_COLUMNS
+        }
+        for name in ("text_offsets", "doc_offsets", "doc_id_offsets"):
+            self._columns[name].append(0)
+        self._spills = {name: tempfile.TemporaryFile() for name in self._columns}
+        self._text_size = 0
+        self._doc_id_size = 0
+
+    def write(self, doc_id, entities: list, **fields):
+        """add the entities of the document doc_id"""
+        self._write_document(doc_id, entities, fields)
+        self.nb_documents += 1
+        self.nb_entities += len(entities)
+        buffered = sum(len(col) * col.itemsize for col in self._columns.values())
+        if buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """move the buffered columns to the temporary files"""
+        for name, column in self._columns.items():
+            if sys.byteorder == "big":
+                column.byteswap()
+            self._spills[name].write(column.tobytes())
+            del column[:]
+
+    def close(self):
+        """write the header and the columns to the file"""
+        if self._file.closed:
+            return
+        self.flush()
+        self._spills["doc_id_order"].write(self._doc_id_order().tobytes())
+        columns, offset = {}, 0
+        for name, _, dtype in COLUMNAR_COLUMNS:
+            size = self._spills[name].tell()
+            columns[name] = [offset, dtype, size // np.dtype(dtype).itemsize]
+            offset += size + (-size % 8)
+        header = json.dumps(
+            {
+                "nb_documents": self.nb_documents,
+                "nb_entities": self.nb_entities,
+                "labels": list(self.labels),
+                "columns": columns,
+            }
+        ).encode("UTF-8")
+        # the columns start at a multiple of 8 bytes
+        header += b" " * (-len(header) % 8)
+        self._file.write(COLUMNAR_MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, _, _ in COLUMNAR_COLUMNS:
+            spill = self._spills[name]
+            self._file.write(b"\x00" * (-self._file.tell() % 8))
+            spill.seek(0)
+            shutil.copyfileobj(spill, self._file)
+            spill.close()
+        self._file.close()
+        logging.info(
+            f"{self.nb_documents} documents ({self.nb_entities} entities) written to {self.out_file}"
+        )
+
+    def _doc_id_order(self) -> np.ndarray:
+        """return the document indices sorted by the bytes of their ids"""
+        spills = self._spills
+        spills["doc_id_offsets"].seek(0)
+        offsets = np.frombuffer(spills["doc_id_offsets"].read(), dtype="<u8").tolist()
+        spills["doc_id_heap"].seek(0)
+        heap = spills["doc_id_heap"].read()
+        order = sorted(
+            range(self.nb_documents),
+            key=lambda doc: heap[offsets[doc] : offsets[doc + 1]],
+        )
+        return np.array(order, dtype="<u4")
+
+    def _write_document(self, doc_id, entities: list, fields: dict):
+        columns = self._columns
+        for ent in entities:
+            label = self.labels.setdefault(ent["annotation"], len(self.labels))
+            text = ent["text"].encode("UTF-8")
+            self._text_size += len(text)
+            columns["doc"].append(self.nb_documents)
+            columns["start"].append(ent["start"])
+            columns["end"].append(ent["end"])
+            columns["label"].append(label)
+            columns["text_offsets"].append(self._text_size)
+            columns["text_heap"].frombytes(text)
+        doc_id = str(doc_id).encode("UTF-8")
+        self._doc_id_size += len(doc_id)
+        columns["doc_offsets"].append(self.nb_entities + len(entities))
+        columns["doc_id_offsets"].append(self._doc_id_size)
+        columns["doc_id_heap"].frombytes(doc_id)
+
+
+class ColumnarReader:
+    """read a file written by ColumnarSink without parsing it: the file is
+    memory-mapped and only the columns and the entities used are read
+    >>> with ColumnarReader("entities.nerc") as reader:
+    ...     reader.label_counts()
+    ...     for ent in reader.entities(reader.select(labels="PERSON")):
+    ...         print(ent)
+    {'PERSON': 3, 'GPE': 2}
+    {'id': 'doc1.txt', 'text': 'Obama', 'annotation': 'PERSON', 'start': 0, 'end': 5}
+    ...
+    """
+
+    def __init__(self, in_file: str):
+        self.in_file = in_file
+        with open(in_file, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{in_file} is not a columnar entity file")
+        position = len(COLUMNAR_MAGIC)
+        (header_length,) = struct.unpack_from("<Q", self._mmap, position)
+        position += 8
+        header = json.loads(self._mmap[position : position + header_length])
+        data_start = position + header_length
+        self.nb_documents = header["nb_documents"]
+        self.nb_entities = header["nb_entities"]
+        self.labels = header["labels"]
+        self._columns = {
+            name: np.frombuffer(
+                self._mmap, dtype=dtype, count=count, offset=data_start + offset
+            )
+            for name, (offset, dtype, count) in header["columns"].items()
+        }
+        # positions of the heaps in the file
+        self._heaps = {
+            name: data_start + header["columns"][name][0]
+            for name in ("text_heap", "doc_id_heap")
+        }
+
+    def __len__(self):
+        return self.nb_entities
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self._columns = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # arrays returned by column() still use the file
+            logging.debug(f"{self.in_file} stays mapped until its arrays are freed")
+
+    def column(self, name: str) -> np.ndarray:
+        """return the column of the entities ("doc", "start", "end", "label")
+        as a read-only array backed by the file"""
+        return self._columns[name]
+
+    def doc_id(self, doc: int) -> str:
+        """return the id of the document of index doc"""
+        offsets = self._columns["doc_id_offsets"]
+        return self._heap_string("doc_id_heap", offsets[doc], offsets[doc + 1])
+
+    def text(self, index: int) -> str:
+        """return the text of the entity index"""
+        offsets = self._columns["text_offsets"]
+        return self._heap_string("text_heap", offsets[index], offsets[index + 1])
+
+    def label_counts(self) -> dict:
+        """return the number of entities of each label"""
+        counts = np.bincount(self._columns["label"], minlength=len(self.labels))
+        return dict(zip(self.labels, counts.tolist()))
+
+    def select(self, labels=None, doc_ids=None) -> np.ndarray:
+        """return the indices of the entities having one of the labels and
+        belonging to one of the documents doc_ids (all the entities if None)
+        >>> reader.select(labels=["PERSON", "ORG"], doc_ids="doc1.txt")
+        array([0, 3, 4])
+        """
+        if doc_ids is None:
+            indices = np.arange(self.nb_entities)
+        else:
+            if isinstance(doc_ids, (str, int)):
+                doc_ids = [doc_ids]
+            doc_offsets = self._columns["doc_offsets"]
+            docs = sorted(
+                doc for doc_id in doc_ids for doc in self._find_documents(doc_id)
+            )
+            # the entities of a document are contiguous
+            indices = np.concatenate(
+                [
+                    np.arange(int(doc_offsets[doc]), int(doc_offsets[doc + 1]))
+                    for doc in docs
+                ]
+                or [np.arange(0)]
+            )
+        if labels is None:
+            return indices
+        if isinstance(labels, str):
+            labels = [labels]
+        label_ids = [
+            self.labels.index(label) for label in labels if label in self.labels
+        ]
+        label_column = self._columns["label"]
+        if doc_ids is None:
+            return np.flatnonzero(np.isin(label_column, label_ids))
+        return indices[np.isin(label_column[indices], label_ids)]
+
+    def entities(self, indices=None):
+        """yield the entities of the indices (all the entities if None) as
+        dicts: {"id": doc id, "text", "annotation", "start", "end"}"""
+        if indices is None:
+            indices = range(self.nb_entities)
+        for index in indices:
+            entity = {"id": self.doc_id(self._columns["doc"][index])}
+            entity.update(self._entity(index))
+            yield entity
+
+    def document(self, doc_id) -> list:
+        """return the entities of the document doc_id
+        (in the format of NETagger.predict())"""
+        return [self._entity(index) for index in self.select(doc_ids=doc_id)]
+
+    def documents(self):
+        """yield the (doc_id, entities) of the documents"""
+        doc_offsets = self._columns["doc_offsets"]
+        for doc in range(self.nb_documents):
+            indices = range(int(doc_offsets[doc]), int(doc_offsets[doc + 1]))
+            yield self.doc_id(doc), [self._entity(index) for index in indices]
+
+    def _entity(self, index: int) -> dict:
+        return {
+            "text": self.text(index),
+            "annotation": self.labels[self._columns["label"][index]],
+            "start": int(self._columns["start"][index]),
+            "end": int(self._columns["end"][index]),
+        }
+
+    def _find_documents(self, doc_id) -> list:
+        """return the indices of the documents doc_id, found by binary search
+        in the document indices sorted by id"""
+        key = str(doc_id).encode("UTF-8")
+        order = self._columns["doc_id_order"]
+        offsets = self._columns["doc_id_offsets"]
+
+        def doc_id_bytes(doc):
+            return self._heap_bytes("doc_id_heap", offsets[doc], offsets[doc + 1])
+
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if doc_id_bytes(order[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        docs = []
+        while low < len(order) and doc_id_bytes(order[low]) == key:
+            docs.append(int(order[low]))
+            low += 1
+        return docs
+
+    def _heap_bytes(self, heap: str, start: int, end: int) -> bytes:
+        position = self._heaps[heap]
+        return self._mmap[position + start : position + end]
+
+    def _heap_string(self, heap: str, start: int, end: int) -> str:
+        return self._heap_bytes(heap, start, end).decode("UTF-8")
+
+
 def get_style_sheet():
     "return the text contained in the css file"
 
@@ -252,6 +734,116 @@ def get_style_sheet():
     return css
 
 
+class PrefixIndex:
+    """index of the strings of the text, to find the shortest strings
+    occurring only once in the text that end at a given position
+    >>> index = PrefixIndex("abcab abc")
+    >>> index.unique_prefix_start(9, min_length=1, step=1)
+        5
+
+    It is a suffix array of the reversed text (the strings ending at a position
+    of the text are the prefixes of a suffix of the reversed text), built once.
+    A string ending at end occurs only once if it is longer than the longest
+    common prefix of its reversed suffix with the neighbour suffixes in the array.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        codes = np.frombuffer(text.encode("UTF-32-LE", "surrogatepass"), np.uint32)
+        # suffix array of the reversed text, and rank of each suffix
+        self.suffixes, self.ranks = suffix_array(codes[::-1])
+
+    def unique_length(self, end: int) -> int:
+        """return the length of the shortest text[end - length:end] occurring
+        only once in the text (end + 1 if text[:end] occurs more than once)"""
+        position = len(self.text) - end
+        rank = self.ranks[position]
+        max_common = 0
+        for neighbour_rank in (rank - 1, rank + 1):
+            if 0 <= neighbour_rank < len(self.suffixes):
+                neighbour_end = len(self.text) - int(self.suffixes[neighbour_rank])
+                max_common = max(
+                    max_common,
+                    common_prefix_length(
+                        self.text,
+                        self.text,
+                        reverse=True,
+                        end_a=end,
+                        end_b=neighbour_end,
+                    ),
+                )
+        return max_common + 1
+
+    def unique_prefix_start(self, end: int, min_length=100, step=50) -> int:
+        """return the start of the shortest prefix text[start:end] occurring only
+        once in the text, of min_length, min_length + step, ... characters,
+        0 if none of the prefixes shorter than end is unique"""
+        if min_length >= end:
+            return 0
+        unique_length = self.unique_length(end)
+        length = min_length + max(0, -(-(unique_length - min_length) // step)) * step
+        return end - length if length < end else 0
+
+
+def suffix_array(codes: np.ndarray):
+    """return the (suffix array, rank of each suffix) of the array of codes
+
+    built by prefix doubling, only the suffixes whose rank is not unique yet
+    are sorted again at each step (Larsson-Sadakane)
+    """
+    nb_codes = len(codes)
+    if not nb_codes:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    positions = np.arange(nb_codes)
+    # suffixes sorted by their first 3 codes (the unicode code points
+    # are less than 2**21), 0 after the end of the codes
+    length = 3
+    first_codes = np.zeros(nb_codes, np.int64)
+    for i in range(length):
+        first_codes[: nb_codes - i] |= (codes[i:].astype(np.int64) + 1) << (
+            21 * (length - 1 - i)
+        )
+    suffixes = np.argsort(first_codes, kind="stable")
+    sorted_codes = first_codes[suffixes]
+    # group_starts[i] is True if suffixes[i] is the first suffix of its group
+    # (the suffixes of a group start with the same length codes)
+    group_starts = np.empty(nb_codes, bool)
+    group_starts[0] = True
+    group_starts[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    # rank of a suffix: index of the first suffix of its group in suffixes
+    ranks = np.empty(nb_codes, np.int64)
+    ranks[suffixes] = np.maximum.accumulate(np.where(group_starts, positions, 0))
+    while length < nb_codes:
+        # the suffixes in groups of more than one suffix
+        single = group_starts & np.append(group_starts[1:], True)
+        unsorted = np.flatnonzero(~single)
+        if not len(unsorted):
+            break
+        group_suffixes = suffixes[unsorted]
+        group_ranks = ranks[group_suffixes]
+        next_ranks = np.full(len(unsorted), -1, np.int64)
+        has_next = group_suffixes + length < nb_codes
+        next_ranks[has_next] = ranks[group_suffixes[has_next] + length]
+        # the groups stay in place, the suffixes are sorted inside the groups
+        order = np.argsort(group_ranks * (nb_codes + 1) + next_ranks + 1)
+        group_suffixes = group_suffixes[order]
+        group_ranks = group_ranks[order]
+        next_ranks = next_ranks[order]
+        suffixes[unsorted] = group_suffixes
+        new_starts = np.empty(len(unsorted), bool)
+        new_starts[0] = True
+        new_starts[1:] = (group_ranks[1:] != group_ranks[:-1]) | (
+            next_ranks[1:] != next_ranks[:-1]
+        )
+        group_starts[unsorted] = new_starts
+        first_of_group = np.maximum.accumulate(
+            np.where(new_starts, np.arange(len(unsorted)), 0)
+        )
+        ranks[group_suffixes] = unsorted[first_of_group]
+        length *= 2
+    return suffixes, ranks
+
+
 def occurrences(text, sub):
     count = start = 0
     while True:
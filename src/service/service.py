@@ -0,0 +1,395 @@
+#!/bin/python3.6
+"""
+asyncio NER service: the sentences of concurrent requests are tagged together
+
+    python src/service/service.py --port 8000 --max-batch-size 32 --max-wait 0.005
+    curl -d '{"text": "Miguel de Cervantes est né à Alcalá de Henares."}' localhost:8000/tag
+
+The texts are tokenized as soon as they are received and their sequences of
+tokens are put in a bounded queue. A single task takes the sequences from the
+queue, waits at most max_wait seconds to gather max_batch_size sequences, and
+sends them to the shared model in one batch. Each request gets its entities once
+all its sequences are tagged.
+Use --backend stub to run the service without loading the BERT models.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import inspect
+import json
+import logging
+import os
+import sys
+from array import array
+
+__location__ = os.path.join(
+    os.getcwd(), os.path.dirname(inspect.getfile(inspect.currentframe()))
+)
+sys.path.insert(0, os.path.join(__location__, ".."))
+
+import ner.ner
+from ner.ner import LABELS, NETagger, TaggerMetrics, check_text, detect_language
+
+# maximum size of the body of a http request
+MAX_BODY_SIZE = 10_000_000
+
+
+class ServiceOverloaded(Exception):
+    """the queue of the service stayed full for more than queue_timeout seconds"""
+
+
+class _Request:
+    """a text being tagged by the service"""
+
+    def __init__(self, text: str, tokens, labels, nb_sequences: int, future):
+        self.text = text
+        self.tokens = tokens
+        self.labels = labels
+        # number of sequences not tagged yet
+        self.remaining = nb_sequences
+        self.future = future
+
+
+class NERService:
+    """perform NER on the texts of concurrent callers with micro-batches
+
+    >>> service = NERService(NETagger(train_model=False))
+    >>> async with service:
+    ...     entities = await service.tag("Miguel de Cervantes est né à Alcalá.")
+
+    The sequences of the texts (see NETagger._tokenize()) wait in a queue of
+    max_queue_size sequences, they are sent to the model by batches of at most
+    max_batch_size sequences, a batch is sent at most max_wait seconds after its
+    first sequence is received.
+    When the queue is full, tag() waits for free room (backpressure), and raises
+    ServiceOverloaded if it waited more than queue_timeout seconds.
+    The model is called by a single thread, so it is shared by all the requests.
+    """
+
+    def __init__(
+        self,
+        tagger: NETagger = None,
+        max_batch_size=32,
+        max_wait=0.005,
+        max_queue_size=1024,
+        queue_timeout=None,
+        length=250,
+        pack_sentences=True,
+    ):
+        self.tagger = tagger if tagger is not None else NETagger(train_model=False)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.length = length
+        self.pack_sentences = pack_sentences
+        # number of batches and of sequences sent to the model
+        self.nb_batches = 0
+        self.nb_sequences = 0
+        self._queue = None
+        self._new_sequences = None
+        self._batch_task = None
+        # the model runs in a single thread, the tokenization in the default executor
+        self._model_executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.stop()
+
+    @property
+    def queue_size(self) -> int:
+        """number of sequences waiting to be tagged"""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def start(self):
+        """start the task sending the batches to the model"""
+        if self._batch_task is not None:
+            return
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._new_sequences = asyncio.Event()
+        self._model_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._batch_task = asyncio.ensure_future(self._batch_loop())
+        logging.info(
+            f"NER service started (max_batch_size: {self.max_batch_size},"
+            f" max_wait: {self.max_wait}s, max_queue_size: {self.max_queue_size})"
+        )
+
+    async def stop(self):
+        """stop the service, the pending requests are cancelled"""
+        if self._batch_task is None:
+            return
+        self._batch_task.cancel()
+        try:
+            await self._batch_task
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            request, _ = self._queue.get_nowait()
+            request.future.cancel()
+        self._model_executor.shutdown(wait=True)
+        self._batch_task = None
+        logging.info("NER service stopped")
+
+    async def tag(self, text: str, language: str = None) -> list:
+        """return the entities of the text (see NETagger.predict())"""
+        if self._batch_task is None:
+            raise RuntimeError("the service is not started")
+        loop = asyncio.get_event_loop()
+        check_text(text)
+        if self.tagger.metrics is not None:
+            # the requests are tagged together, their stages are not measured
+            # one by one (TaggerMetrics.last)
+            self.tagger.metrics.count("calls")
+            self.tagger.metrics.count("documents")
+        tokens, sequences, language = await loop.run_in_executor(
+            None, self._tokenize, text, language
+        )
+        non_ent = LABELS.id(self.tagger._default_non_ent)
+        # the tokens between sentences are not sent to the model
+        labels = array("H", [non_ent]) * len(tokens)
+        request = _Request(text, tokens, labels, len(sequences), loop.create_future())
+        if not sequences:
+            return self.tagger._decode(text, tokens, labels)
+
+        for ranges in sequences:
+            sequence_language = tokens.languages.get(ranges[0][0], language)
+            item = (request, (sequence_language, tokens, ranges))
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # backpressure: waiting for the batches to free some room
+                try:
+                    await asyncio.wait_for(self._queue.put(item), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    # the sequences already queued are skipped (future is done)
+                    request.future.cancel()
+                    raise ServiceOverloaded(
+                        f"the queue is full ({self.max_queue_size} sequences)"
+                    )
+            self._new_sequences.set()
+        return await request.future
+
+    def _tokenize(self, text: str, language: str = None):
+        """return the (tokens, sequences, language) of the text"""
+        if not language:
+            language = self.tagger.language or detect_language(text)
+        tokens, sequences = self.tagger._tokenize(
+            text, language, self.length, self.pack_sentences
+        )
+        return tokens, sequences, language
+
+    async def _next_batch(self) -> list:
+        """return the sequences of the next batch,
+        wait at most max_wait seconds after the first one for the batch to be full"""
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            self._new_sequences.clear()
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._new_sequences.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        # skipping the sequences of the cancelled requests
+        return [item for item in batch if not item[0].future.done()]
+
+    async def _batch_loop(self):
+        """send the batches of sequences to the model and complete the requests"""
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                seq_labels = await loop.run_in_executor(
+                    self._model_executor,
+                    self.tagger._label_sequences,
+                    [sequence for _, sequence in batch],
+                    self.max_batch_size,
+                )
+            except Exception as e:
+                logging.exception(
+                    f"error while tagging a batch of {len(batch)} sequences"
+                )
+                for request, _ in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            self.nb_batches += 1
+            self.nb_sequences += len(batch)
+
+            for (request, (_, _, ranges)), seq_label in zip(batch, seq_labels):
+                if request.future.done():
+                    continue
+                for start, end in ranges:
+                    request.labels[start:end] = seq_label[: end - start]
+                    seq_label = seq_label[end - start :]
+                request.remaining -= 1
+                if request.remaining == 0:
+                    try:
+                        entities = self.tagger._decode(
+                            request.text, request.tokens, request.labels
+                        )
+                    except Exception as e:
+                        request.future.set_exception(e)
+                    else:
+                        request.future.set_result(entities)
+
+
+async def handle_http(service: NERService, reader, writer):
+    """answer a http request:
+    POST /tag {"text": "...", "language": "fr"} -> {"entities": [...]}
+    GET /health -> {"status": "ok", "queue_size": 0}
+    GET /metrics -> {"seconds": {...}, "counts": {...}} (see TaggerMetrics)
+    """
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        content_length = int(headers.get("content-length", 0))
+        if content_length > MAX_BODY_SIZE:
+            status, response = 413, {"error": "request body too large"}
+        else:
+            body = await reader.readexactly(content_length)
+            status, response = await _route(service, request_line, body)
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        status, response = 400, {"error": str(e)}
+
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+    reasons.update({413: "Payload Too Large", 500: "Internal Server Error"})
+    reasons.update({503: "Service Unavailable"})
+    payload = json.dumps(response, ensure_ascii=False).encode("UTF-8")
+    writer.write(
+        f"HTTP/1.1 {status} {reasons[status]}\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        "Connection: close\r\n\r\n".encode("latin-1") + payload
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _route(service: NERService, request_line: list, body: bytes):
+    """return the (status, response) of the request"""
+    if len(request_line) < 2:
+        raise ValueError("incorrect request line")
+    method, path = request_line[0], request_line[1]
+    if method == "GET" and path == "/health":
+        return 200, {"status": "ok", "queue_size": service.queue_size}
+    if method == "GET" and path == "/metrics" and service.tagger.metrics is not None:
+        metrics = service.tagger.metrics.to_dict()
+        del metrics["last"]
+        metrics["counts"].update(
+            {"batches": service.nb_batches, "batched_sequences": service.nb_sequences}
+        )
+        return 200, metrics
+    if method != "POST" or path != "/tag":
+        return 404, {"error": f"no route for {method} {path}"}
+
+    data = json.loads(body.decode("UTF-8"))
+    if not isinstance(data, dict) or not isinstance(data.get("text"), str):
+        raise ValueError('the body should be {"text": "...", "language": "..."}')
+    if not data["text"]:
+        return 200, {"entities": []}
+    try:
+        entities = await service.tag(data["text"], data.get("language"))
+    except ServiceOverloaded as e:
+        return 503, {"error": str(e)}
+    except Exception as e:
+        logging.exception("error while tagging a text")
+        return 500, {"error": str(e)}
+    return 200, {"entities": entities}
+
+
+async def serve(service: NERService, host="127.0.0.1", port=8000):
+    """start the service and answer the http requests until cancelled"""
+    await service.start()
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_http(service, reader, writer), host, port
+    )
+    logging.info(f"listening on http://{host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await service.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="http NER service tagging the concurrent requests by micro-batches"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--language", help="language of the texts (detected if not set)"
+    )
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait", type=float, default=0.005, help="in seconds")
+    parser.add_argument("--max-queue-size", type=int, default=1024)
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        help="answer 503 if the queue stays full for more seconds",
+    )
+    parser.add_argument(
+        "--backend",
+        default="deeppavlov",
+        choices=["deeppavlov", "quantized", "stub"],
+        help="quantized: int8 models on CPU",
+    )
+    parser.add_argument(
+        "--stub-delay",
+        type=float,
+        default=0.0,
+        help="seconds slept by each call of the stub backend",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="measure the stages (GET /metrics)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    ner.ner.STUB_DELAY = args.stub_delay
+    tagger = NETagger(
+        language=args.language,
+        backend=args.backend,
+        metrics=TaggerMetrics() if args.metrics else None,
+    )
+    service = NERService(
+        tagger,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+        max_queue_size=args.max_queue_size,
+        queue_timeout=args.queue_timeout,
+    )
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/bin/python3.6
+"""
+string helpers without dependencies, shared by the ner and serialize packages
+"""
+
+
+def common_prefix_length(
+    a: str, b: str, reverse=False, end_a: int = None, end_b: int = None
+) -> int:
+    """return the length of the common prefix (suffix if reverse) of a[:end_a]
+    and b[:end_b] (the whole strings if not set), without copying them
+    >>> common_prefix_length("abcd", "abxd")
+        2
+    >>> common_prefix_length("xabc", "yabc", reverse=True)
+        3
+
+    the strings are compared by blocks of increasing size, so that the time
+    depends on the length of the common prefix, not on the length of the strings
+    """
+    end_a = len(a) if end_a is None else end_a
+    end_b = len(b) if end_b is None else end_b
+    max_length = min(end_a, end_b)
+
+    def block(string, string_end, start, end):
+        # string[start:end], counted from string_end if reverse
+        if reverse:
+            return string[string_end - end : string_end - start]
+        return string[start:end]
+
+    length, size = 0, 64
+    while length < max_length:
+        end = min(length + size, max_length)
+        if block(a, end_a, length, end) != block(b, end_b, length, end):
+            break
+        length, size = end, size * 2
+    else:
+        return max_length
+    # the first difference is in the block [length, end), binary search:
+    low, high = length, end - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if block(a, end_a, length, middle) == block(b, end_b, length, middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
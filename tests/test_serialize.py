@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from serialize.serialize import ColumnarReader, ColumnarSink, open_sink
+
+ENTITIES = [{"annotation": "PERSON", "text": "Obama", "start": 0, "end": 5}]
+
+
+class OpenColumnarSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.out_file = os.path.join(self.directory.name, "entities.nerc")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_write_and_read(self):
+        with open_sink(self.out_file, buffer_size=16) as sink:
+            sink.write("doc1.txt", ENTITIES)
+        with ColumnarReader(self.out_file) as reader:
+            self.assertEqual(reader.document("doc1.txt"), ENTITIES)
+
+    def test_append_is_refused(self):
+        with open_sink(self.out_file) as sink:
+            sink.write("doc1.txt", ENTITIES)
+        with self.assertRaisesRegex(ValueError, "appended"):
+            open_sink(self.out_file, append=True)
+        # the existing file is kept
+        with ColumnarReader(self.out_file) as reader:
+            self.assertEqual(reader.document("doc1.txt"), ENTITIES)
+
+    def test_compression_is_refused(self):
+        with self.assertRaisesRegex(ValueError, "not compressed"):
+            open_sink(self.out_file, compression="gzip")
+        with self.assertRaisesRegex(ValueError, "not compressed"):
+            ColumnarSink(self.out_file, compression="gzip")
+        with self.assertRaisesRegex(ValueError, "not compressed"):
+            open_sink(self.out_file + ".gz")
+
+
+if __name__ == "__main__":
+    unittest.main()